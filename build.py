@@ -0,0 +1,17 @@
+import sys
+import logging
+from lib.build import BuildManifest, BuildOrchestrator
+
+logging.basicConfig(level=logging.DEBUG)
+
+MANIFEST_FILE = "build_manifest.yaml"
+
+if __name__ == "__main__":
+    manifest = BuildManifest.load(sys.argv[1] if len(sys.argv) > 1 else MANIFEST_FILE)
+    results = BuildOrchestrator(manifest).run(force="--force" in sys.argv)
+
+    for name, status in results.items():
+        print(f"{name}: {status}")
+
+    if "failed" in results.values():
+        sys.exit(1)
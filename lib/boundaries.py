@@ -0,0 +1,91 @@
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+BOUNDARY_CACHE_FOLDER = Path("cache/boundaries")
+BBOX_COLUMNS = ["minx", "miny", "maxx", "maxy"]
+ROW_GROUP_ROWS = 2_000
+SORT_CELL_DEGREES = 0.25
+
+
+def utm_areas(gdf):
+    """
+    area in square meters of every polygon, each measured in the UTM zone its bounds are centered in,
+    projecting every zone once
+    """
+    # empty geometries have no bounds and keep a NaN area
+    bounds = gdf.geometry.bounds.dropna()
+    utm_zones = (np.floor(((bounds.minx + bounds.maxx) / 2 + 180) / 6).astype(int) % 60) + 1
+    areas = pd.Series(np.nan, index=gdf.index)
+    for utm_zone in utm_zones.unique():
+        in_zone = utm_zones.index[utm_zones == utm_zone]
+        areas[in_zone] = gdf.geometry[in_zone].to_crs(f'EPSG:{32600 + utm_zone}').area
+    return areas
+
+
+class BoundaryStore:
+    """
+    A boundary shapefile converted once to GeoParquet with its block_group_area and bounding box columns.
+    Rows are sorted into SORT_CELL_DEGREES cells and written in small row groups, so the parquet
+    statistics on the bbox columns act as a coarse spatial index and bbox reads skip most of a state.
+    """
+    def __init__(self, boundaries_file, folder = BOUNDARY_CACHE_FOLDER, logger = None):
+        self.boundaries_file = Path(boundaries_file)
+        self.folder = Path(folder)
+        self.logger = logger
+
+    @property
+    def stamp(self):
+        """
+        path, size and mtime of the shapefile's files, cheap enough to check on every build
+        """
+        sources = sorted(self.boundaries_file.glob("*")) if self.boundaries_file.is_dir() else [self.boundaries_file]
+        stamp = hashlib.sha256()
+        for source in sources:
+            stat = source.stat()
+            stamp.update(f"{source.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return stamp.hexdigest()
+
+    @property
+    def parquet_file(self):
+        # a changed shapefile gets a new file rather than a stale one
+        return self.folder / f"{self.boundaries_file.name}-{self.stamp[:16]}.parquet"
+
+    def build(self):
+        parquet_file = self.parquet_file
+        if parquet_file.is_file():
+            return parquet_file
+
+        self._debug(f"Converting {self.boundaries_file} to {parquet_file}")
+        gdf = gpd.read_file(self.boundaries_file)
+        gdf["block_group_area"] = utm_areas(gdf)
+        bounds = gdf.geometry.bounds
+        for column in BBOX_COLUMNS:
+            gdf[column] = bounds[column]
+
+        cells = np.floor((bounds.miny + bounds.maxy) / 2 / SORT_CELL_DEGREES) * 10_000 + np.floor((bounds.minx + bounds.maxx) / 2 / SORT_CELL_DEGREES)
+        gdf = gdf.iloc[np.argsort(cells.to_numpy(), kind="stable")].reset_index(drop=True)
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        staging = parquet_file.with_suffix(f".tmp-{os.getpid()}")
+        gdf.to_parquet(staging, index=False, row_group_size=ROW_GROUP_ROWS)
+        os.replace(staging, parquet_file)
+        return parquet_file
+
+    def read(self, bbox = None):
+        """
+        boundaries intersecting bbox (minx, miny, maxx, maxy in the boundaries' crs), all of them if bbox is None
+        """
+        filters = None
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            filters = [("maxx", ">=", minx), ("minx", "<=", maxx), ("maxy", ">=", miny), ("miny", "<=", maxy)]
+        gdf = gpd.read_parquet(self.build(), filters=filters)
+        return gdf.drop(columns=BBOX_COLUMNS)
+
+    def _debug(self, message):
+        if self.logger:
+            self.logger.debug(message)
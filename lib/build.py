@@ -0,0 +1,212 @@
+import contextlib
+import hashlib
+import importlib
+import json
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import yaml
+from lib.boundaries import BoundaryStore
+
+DATASET_TYPES = {
+    "dataset": "lib.dataset.Dataset",
+    "delay": "lib.delay_dataset.DelayDataset",
+    "route_plan": "lib.route_plan_dataset.RoutePlanDataset"
+}
+
+
+class CitySpec:
+    """
+    one dataset to build: the constructor arguments of its dataset type plus how to call build
+    """
+    def __init__(self, name, gtfs, census_boundaries_file = None, type = "dataset", save_folder = None, options = None, build_options = None):
+        if type not in DATASET_TYPES:
+            raise Exception(f"Unknown dataset type {type} for {name}, expected one of {list(DATASET_TYPES)}")
+        self.name = name
+        self.gtfs = gtfs
+        self.census_boundaries_file = census_boundaries_file
+        self.type = type
+        self.save_folder = save_folder or f"datasets/{name}"
+        self.options = options or {}
+        self.build_options = build_options or {}
+
+    @property
+    def info(self):
+        return {
+            "name": self.name,
+            "gtfs": self.gtfs,
+            "census_boundaries_file": self.census_boundaries_file,
+            "type": self.type,
+            "save_folder": self.save_folder,
+            "options": self.options,
+            "build_options": self.build_options
+        }
+
+    @property
+    def digest(self):
+        return hashlib.sha256(json.dumps(self.info, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class BuildManifest:
+    """
+    yaml manifest of cities to build:
+
+        max_workers: 2
+        max_retries: 1
+        log_folder: logs/builds
+        cities:
+          - name: sanfrancisco_delay_peak
+            type: delay
+            gtfs: gtfs_data/2023_december/sanfrancisco_gtfs.zip
+            census_boundaries_file: census_boundaries_data/2021/California
+            options: {include_delay: true, delay_sqlite_db_str: realtime/sanfrancisco/realtime.db}
+    """
+    def __init__(self, cities, max_workers = 2, max_retries = 1, log_folder = "logs/builds"):
+        self.cities = cities
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.log_folder = Path(log_folder)
+
+        names = [city.name for city in cities]
+        if len(set(names)) != len(names):
+            raise Exception("City names in a build manifest must be unique")
+
+    @staticmethod
+    def load(filename):
+        with open(filename, "r") as stream:
+            manifest = yaml.safe_load(stream)
+        cities = [CitySpec(**city) for city in manifest["cities"]]
+        return BuildManifest(cities, manifest.get("max_workers", 2), manifest.get("max_retries", 1), manifest.get("log_folder", "logs/builds"))
+
+
+def build_city(city_info, log_file):
+    """
+    builds one city in a worker process, everything it logs or prints goes to log_file
+    """
+    city = CitySpec(**city_info)
+    log_file = Path(log_file)
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(log_file, "a") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        handler = logging.StreamHandler(log)
+        logging.getLogger().addHandler(handler)
+        try:
+            module_name, class_name = DATASET_TYPES[city.type].rsplit(".", 1)
+            dataset_class = getattr(importlib.import_module(module_name), class_name)
+
+            dataset = dataset_class(city.name, city.gtfs, city.census_boundaries_file, save_folder=city.save_folder, **city.options)
+            if city.type == "dataset":
+                dataset._build(**city.build_options)
+            else:
+                dataset.build(**city.build_options)
+        except Exception:
+            traceback.print_exc()
+            raise
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+    return city.name
+
+
+class BuildOrchestrator:
+    """
+    Builds the cities of a manifest in a process pool, at most max_workers at a time.
+    A failed city is resubmitted up to max_retries times. Finished cities are recorded in
+    build_state.json next to the logs with a digest of their spec, and skipped on the next run
+    unless their spec changed.
+    """
+    STATE_FILENAME = "build_state.json"
+
+    def __init__(self, manifest: BuildManifest, logger = None):
+        self.manifest = manifest
+        self.logger = logger or logging.getLogger("build_orchestrator")
+        self.state_file = manifest.log_folder / BuildOrchestrator.STATE_FILENAME
+
+    @property
+    def state(self):
+        if not self.state_file.is_file():
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def _record(self, city, status, error = None):
+        state = self.state
+        state[city.name] = {"status": status, "digest": city.digest, "error": error}
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.state_file, "w+") as f:
+            json.dump(state, f, indent=2)
+
+    def pending(self, force = False):
+        state = self.state
+        return [
+            city for city in self.manifest.cities
+            if force or state.get(city.name, {}).get("status") != "done" or state[city.name].get("digest") != city.digest
+        ]
+
+    def prepare_boundaries(self, cities):
+        # converting a state's boundaries once here means cities sharing the state only do bbox reads
+        for boundaries_file in sorted({city.census_boundaries_file for city in cities if city.census_boundaries_file}):
+            self._debug(f"Preparing census boundaries {boundaries_file}")
+            BoundaryStore(boundaries_file, logger=self.logger).build()
+
+    def run(self, force = False):
+        """
+        returns {city name: "done" | "failed"} for the cities built in this run
+        """
+        cities = self.pending(force)
+        skipped = len(self.manifest.cities) - len(cities)
+        if skipped:
+            self._debug(f"Skipping {skipped} cities already built")
+        if not cities:
+            return {}
+
+        self.prepare_boundaries(cities)
+
+        results = {}
+        attempts = {city.name: 0 for city in cities}
+        executor = ProcessPoolExecutor(max_workers=self.manifest.max_workers)
+
+        def submit(city):
+            nonlocal executor
+            attempts[city.name] += 1
+            self._debug(f"Building {city.name} (attempt {attempts[city.name]})")
+            args = (build_city, city.info, str(self.manifest.log_folder / f"{city.name}.log"))
+            try:
+                return executor.submit(*args)
+            except BrokenProcessPool:
+                # a worker died (oom, segfault) and took the pool with it, every city running in it fails with BrokenProcessPool
+                self._debug("Build worker pool broke, starting a new one")
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=self.manifest.max_workers)
+                return executor.submit(*args)
+
+        try:
+            running = {submit(city): city for city in cities}
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    city = running.pop(future)
+                    error = future.exception()
+                    if isinstance(error, BrokenProcessPool):
+                        error = f"build worker process died: {error}"
+                    if error is None:
+                        self._debug(f"Finished {city.name}")
+                        self._record(city, "done")
+                        results[city.name] = "done"
+                    elif attempts[city.name] <= self.manifest.max_retries:
+                        self._debug(f"{city.name} failed ({error}), retrying")
+                        running[submit(city)] = city
+                    else:
+                        self._debug(f"{city.name} failed after {attempts[city.name]} attempts: {error}")
+                        self._record(city, "failed", str(error))
+                        results[city.name] = "failed"
+        finally:
+            executor.shutdown()
+
+        return results
+
+    def _debug(self, message):
+        if self.logger:
+            self.logger.debug(message)
@@ -1,12 +1,21 @@
 from collections import defaultdict
 import json
+import random
 from pathlib import Path
 from tqdm import tqdm
 import lib.util as util
+from lib.spatial import CoordinateStore, StopIndex
 import pandas as pd
 import networkx as nx
 import numpy as np
 
+GTFS_COLUMNS = {
+    "stops": ["stop_id", "stop_name", "stop_lat", "stop_lon"],
+    "trips": ["trip_id", "route_id", "service_id"],
+    "stop_times": ["trip_id", "stop_id", "stop_sequence", "departure_time"],
+    "routes": ["route_id"]
+}
+
 class BusPlanState:
     def __init__(self, name: str, node_attributes: pd.DataFrame, cosine_latitude: float, save_folder: str, from_json = None):
         self.name = name
@@ -14,6 +23,9 @@ class BusPlanState:
         self.node_attributes = node_attributes
         self.cosine_latitude = cosine_latitude
         self.save_folder = save_folder
+        self._coordinates = None
+        self._stop_index = None
+        self.stop_neighbors = None
         
         self.shortest_intervals = {}
         self.routes_to_stops = defaultdict(list)
@@ -102,6 +114,33 @@ class BusPlanState:
         return similarity
         
     
+    @property
+    def coordinates(self):
+        if self._coordinates is None:
+            self._coordinates = CoordinateStore(self.node_attributes.geometry, self.cosine_latitude)
+        return self._coordinates
+
+    @property
+    def stop_index(self):
+        if self._stop_index is None:
+            self._stop_index = StopIndex(self.coordinates)
+        return self._stop_index
+
+    def random_nearby_stop(self, stop_id, radius_meters):
+        """
+        a random stop within radius_meters of stop_id, from the precomputed stop_neighbors tables when they have that radius
+        """
+        if self.stop_neighbors is not None and radius_meters in self.stop_neighbors.tables:
+            return self.stop_neighbors.random_neighbor(stop_id, radius_meters)
+        return random.choice(self.stop_index.within(self.node_attributes.geometry.loc[stop_id], radius_meters))
+
+    def route_corridor_stops(self, route_id, distance_meters):
+        """
+        every stop within distance_meters of the path driven by route_id
+        """
+        route_points = self.node_attributes.geometry.loc[self.routes_to_stops[route_id]]
+        return self.stop_index.near_segments(list(route_points), distance_meters)
+
     def _load_json(self, json_dict):
         self.shortest_intervals = json_dict["shortest_intervals"]
         self.routes_to_stops.update(json_dict["routes_to_stops"])
@@ -119,13 +158,11 @@ class BusPlanState:
             json.dump(data, f)
 
     def route_travel_time(self, route_id):
-        total_time = 0
-        for i in range(1, len(self.routes_to_stops[route_id])):
-            u = self.routes_to_stops[route_id][i - 1]
-            v = self.routes_to_stops[route_id][i]
-            driving_time = (1/util.AVG_BUS_SPEED_METERS_PER_MIN) * util.approx_manhattan_distance_in_meters(self.node_attributes.geometry.loc[u], self.node_attributes.geometry.loc[v], self.cosine_latitude) 
-            total_time += driving_time + util.STOP_PENALTY_MINUTES
-        return total_time
+        stops = self.routes_to_stops[route_id]
+        if len(stops) < 2:
+            return 0
+        driving_times = self.coordinates.driving_times(stops[:-1], stops[1:])
+        return float(np.sum(driving_times + util.STOP_PENALTY_MINUTES))
     
     @property
     def total_bus_minutes(self):
@@ -250,17 +287,25 @@ class BusPlanState:
 
 
     @staticmethod
-    def create_from_feed(gtfs_zip_file, node_attributes, cosine_latitude, save_folder):
+    def create_from_feed(gtfs_zip_file, node_attributes, cosine_latitude, save_folder, stream_stop_times = False, service_date = None, day_type = None):
         shortest_intervals = {}
         routes_to_stops = defaultdict(list)
         stops_to_routes = defaultdict(set)
         G = nx.DiGraph()
     
-        stops, trips, stop_times, routes = util.load_gtfs_zip(gtfs_zip_file)
-        stop_times = stop_times.merge(trips[["trip_id","route_id"]], on="trip_id",how="left")
-        stop_times = stop_times[['route_id', 'trip_id', 'stop_id', 'stop_sequence', 'departure_time']]
-        stop_times = stop_times.merge(stops[["stop_id", "stop_name"]], on="stop_id",how="left")
-        first_departure_times = stop_times[stop_times.stop_sequence == 1].sort_values('departure_time')
+        stops, trips, stop_times, routes = util.load_gtfs_zip(gtfs_zip_file, columns=GTFS_COLUMNS, include_stop_times=not stream_stop_times, service_date=service_date, day_type=day_type)
+        service_trip_ids = trips.trip_id if (service_date or day_type) else None
+        if stream_stop_times:
+            # only the first stop of every trip is needed for headways
+            first_stop_times = util.read_stop_times(gtfs_zip_file, columns=GTFS_COLUMNS["stop_times"], trip_ids=service_trip_ids, row_filter=lambda chunk: chunk.stop_sequence == 1)
+        else:
+            first_stop_times = stop_times[stop_times.stop_sequence == 1]
+        first_stop_times = first_stop_times.merge(trips[["trip_id","route_id"]], on="trip_id",how="left")
+        first_stop_times = first_stop_times[['route_id', 'trip_id', 'stop_id', 'stop_sequence', 'departure_time']]
+        first_stop_times = first_stop_times.merge(stops[["stop_id", "stop_name"]], on="stop_id",how="left")
+        first_departure_times = first_stop_times.sort_values('departure_time')
+
+        chosen_trips = {}
         for route_id in tqdm(routes.route_id.unique()):
             frequency_by_origin = []
             route_times = first_departure_times[first_departure_times.route_id == route_id]
@@ -290,9 +335,18 @@ class BusPlanState:
             first_trip_time = (round(first_trip_time) + util.FIVE_HOURS_IN_MINUTES) % util.ONE_DAY_IN_MINUTES
             last_trip_time = (round(last_trip_time) + util.FIVE_HOURS_IN_MINUTES) % util.ONE_DAY_IN_MINUTES
 
+            chosen_trips[route_id] = (shortest_interval, first_trip_id)
+
+        chosen_trip_ids = [first_trip_id for _, first_trip_id in chosen_trips.values()]
+        if stream_stop_times:
+            trip_stop_times = util.read_stop_times(gtfs_zip_file, columns=GTFS_COLUMNS["stop_times"], trip_ids=chosen_trip_ids)
+        else:
+            trip_stop_times = stop_times[stop_times.trip_id.isin(chosen_trip_ids)]
+
+        for route_id, (shortest_interval, first_trip_id) in chosen_trips.items():
             routes_to_stops[route_id] = []
             
-            for i, row in stop_times[stop_times.trip_id == first_trip_id].sort_values("stop_sequence").iterrows():
+            for i, row in trip_stop_times[trip_stop_times.trip_id == first_trip_id].sort_values("stop_sequence").iterrows():
                 stop_id = row["stop_id"]
 
                 shortest_intervals[route_id] = shortest_interval
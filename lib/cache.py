@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+from pathlib import Path
+
+
+FINGERPRINT_HASH_MAX_BYTES = 256 << 20
+
+
+class OfflineCacheMiss(Exception):
+    pass
+
+
+def fingerprint(path):
+    """
+    identifies the contents of a file or folder for cache keys: a sha256 of files up to
+    FINGERPRINT_HASH_MAX_BYTES, size and mtime for larger ones (sqlite dbs), combined over a folder
+    """
+    if not path:
+        return None
+    path = Path(path)
+    if not path.exists():
+        return f"missing:{path}"
+    if path.is_dir():
+        return hashlib.sha256("".join(f"{p.name}:{fingerprint(p)}" for p in sorted(path.iterdir())).encode()).hexdigest()
+
+    stat = path.stat()
+    if stat.st_size > FINGERPRINT_HASH_MAX_BYTES:
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Pickled values on disk keyed by anything json serializable.
+    Entries older than max_age_seconds are treated as missing, and once the folder grows past
+    max_bytes the least recently used entries are removed. In offline mode a miss raises
+    OfflineCacheMiss so callers fail before touching the network.
+    """
+    def __init__(self, folder, max_age_seconds = None, max_bytes = None, offline = False):
+        self.folder = Path(folder)
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return self.folder / f"{DiskCache.digest(key)}.pkl"
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                created, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return self._miss(key)
+
+        if self.max_age_seconds is not None and time.time() - created > self.max_age_seconds:
+            path.unlink(missing_ok=True)
+            return self._miss(key)
+
+        # mtime is the last use, used for eviction. another process may have evicted the entry since we read it
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        staging = path.with_suffix(f".tmp-{os.getpid()}")
+        with open(staging, "wb") as f:
+            pickle.dump((time.time(), value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(staging, path)
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None or not self.folder.is_dir():
+            return
+        entries = []
+        for p in self.folder.glob("*.pkl"):
+            # build processes share the folder, entries can disappear while we list them
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, p))
+        entries.sort(key=lambda e: e[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+
+    def _miss(self, key):
+        if self.offline:
+            raise OfflineCacheMiss(f"{key} is not cached in {self.folder} and the cache is offline")
+        return None
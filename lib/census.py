@@ -1,14 +1,31 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
 import pandas as pd
 from tqdm import tqdm
 import yaml
 import requests
 from shapely.geometry import Point
 import geopandas as gpd
-import utm
+import numpy as np
+from requests.adapters import HTTPAdapter
+from lib.cache import DiskCache
+from lib.retry import backoff_delay
+from lib.profiler import record_response
+from lib.boundaries import BoundaryStore, utm_areas
 
 pd.options.mode.chained_assignment = None 
 
+CENSUS_API_URL = "https://api.census.gov/data"
+CENSUS_CACHE_FOLDER = "cache/census"
+CENSUS_CACHE_MAX_AGE_SECONDS = 180 * 24 * 60 * 60
+CENSUS_CACHE_MAX_BYTES = 1 << 30
+
+
+def census_cache(offline=False):
+    return DiskCache(CENSUS_CACHE_FOLDER, CENSUS_CACHE_MAX_AGE_SECONDS, CENSUS_CACHE_MAX_BYTES, offline)
+
 
 
 class Table:
@@ -43,12 +60,15 @@ class TableGrouping:
 
 class Query:
     GEO_FIELDS = ["state","county","tract","block group"]
+    # tables per request and tracts per request
+    BATCH_SIZE = 30
 
-    def __init__(self, census_data_source, state_code, county_code, logger=None):
+    def __init__(self, census_data_source, state_code, county_code, logger=None, base_url=CENSUS_API_URL):
         self.census_data_source = census_data_source
         self.state_code = state_code
         self.county_code = county_code
         self.logger = logger
+        self.base_url = base_url.rstrip("/")
 
         self.tracts = []
         self.tables = []
@@ -75,29 +95,46 @@ class Query:
 
     def __str__(self):
         tracts = list(set(self.tracts))
-        return f"https://api.census.gov/data/{self.census_data_source}?get={','.join([str(t) for t in self.tables])}&for=block%20group:*&in=state:{str(self.state_code).zfill(2)}&in=county:{str(self.county_code)}&in=tract:{','.join([str(t) for t in tracts])}"
+        return f"{self.base_url}/{self.census_data_source}?get={','.join([str(t) for t in self.tables])}&for=block%20group:*&in=state:{str(self.state_code).zfill(2)}&in=county:{str(self.county_code)}&in=tract:{','.join([str(t) for t in tracts])}"
     
+    def cache_key(self):
+        """
+        the same tracts and tables in any order and with repeats are the same query,
+        groupings are applied after the cache so they are not part of it
+        """
+        return {
+            "base_url": self.base_url,
+            "data_source": self.census_data_source,
+            "state": str(self.state_code).zfill(2),
+            "county": str(self.county_code),
+            "tracts": sorted(set(str(t) for t in self.tracts)),
+            "tables": sorted(set(str(t) for t in self.tables))
+        }
+
     def get_batched_queries(self):
         tracts = list(set(self.tracts))
-        for i in range(0, len(tracts), 30):
-            yield [f"https://api.census.gov/data/{self.census_data_source}?get={','.join([str(t) for t in self.tables[j:j+30]])}&for=block%20group:*&in=state:{str(self.state_code).zfill(2)}&in=county:{str(self.county_code)}&in=tract:{','.join([str(t) for t in tracts[i:i+30]])}" for j in range(0, len(self.tables), 30)]
-
-    def get(self):
-        dfs = []
-        
-        all_batched_queries = list(self.get_batched_queries())
-        for i, url_list in tqdm(enumerate(all_batched_queries), total=len(all_batched_queries), leave=False):
-            df = pd.DataFrame(columns=Query.GEO_FIELDS)
-            for url in url_list:
-                r = requests.get(url)
-                batchdf = pd.DataFrame(r.json())
-                batchdf.columns = batchdf.iloc[0]
-                batchdf = batchdf.drop(0)
-                df = df.merge(batchdf, on=Query.GEO_FIELDS, how='outer')
-            dfs.append(df)
-
-        
-        df = pd.concat(dfs).apply(pd.to_numeric)
+        size = Query.BATCH_SIZE
+        for i in range(0, len(tracts), size):
+            yield [f"{self.base_url}/{self.census_data_source}?get={','.join([str(t) for t in self.tables[j:j+size]])}&for=block%20group:*&in=state:{str(self.state_code).zfill(2)}&in=county:{str(self.county_code)}&in=tract:{','.join([str(t) for t in tracts[i:i+size]])}" for j in range(0, len(self.tables), size)]
+
+    def raw_columns(self):
+        """
+        api columns in the order the table batches have always been merged in:
+        the fields of the first batch, the geography it came back with, then the fields of the other batches
+        """
+        first = list(dict.fromkeys(str(t) for t in self.tables[:Query.BATCH_SIZE]))
+        rest = [field for field in dict.fromkeys(str(t) for t in self.tables[Query.BATCH_SIZE:]) if field not in first]
+        return first + Query.GEO_FIELDS + rest
+
+    def get(self, fetcher=None):
+        fetcher = fetcher or CensusFetcher(cache=census_cache(), logger=self.logger)
+        return fetcher.fetch([self])[0]
+
+    def process(self, df):
+        """
+        turns the merged raw api rows of this query into named tables, percentages and groupings
+        """
+        df = df.apply(pd.to_numeric)
 
         for t in self.tables:
             df = df.rename(columns={str(t): t.name})
@@ -115,22 +152,147 @@ class Query:
             self.logger.debug(message)
 
 
+class RateLimiter:
+    """
+    spaces out calls across threads so that at most requests_per_second start each second
+    """
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class CensusFetcher:
+    """
+    Fetches the batched urls of many Queries over one pooled session with a bounded
+    number of requests in flight, retrying failures with exponential backoff.
+    Responses are merged into their query's frame as they arrive.
+    """
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_workers=8, requests_per_second=10, max_retries=4, backoff_seconds=1, timeout_seconds=60, cache=None, logger=None):
+        self.max_workers = max_workers
+        self.cache = cache
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.logger = logger
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.hooks["response"].append(record_response)
+
+    def fetch_url(self, url):
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            try:
+                r = self.session.get(url, timeout=self.timeout_seconds)
+                if r.status_code not in CensusFetcher.RETRY_STATUS_CODES:
+                    r.raise_for_status()
+                    rows = r.json()
+                    batchdf = pd.DataFrame(rows[1:], columns=rows[0])
+                    return batchdf
+                error = f"status {r.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+
+            if attempt < self.max_retries:
+                delay = backoff_delay(self.backoff_seconds, attempt)
+                self._debug(f"Census request failed ({error}), retrying in {delay:.1f}s: {url}")
+                time.sleep(delay)
+
+        raise Exception(f"Census request failed after {self.max_retries + 1} attempts ({error}): {url}")
+
+    def fetch(self, queries):
+        """
+        returns one processed frame per query, in the order of queries,
+        only queries missing from the cache go to the network
+        """
+        raw = {}
+        for q, query in enumerate(queries):
+            if self.cache is not None:
+                cached = self.cache.get(query.cache_key())
+                if cached is not None:
+                    raw[q] = cached
+
+        # (query, tract batch) -> frame of every table batch merged so far
+        merged = {}
+        jobs = []
+        for q, query in enumerate(queries):
+            if q in raw:
+                continue
+            for b, url_list in enumerate(query.get_batched_queries()):
+                jobs.extend(((q, b), url) for url in url_list)
+
+        if jobs:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self.fetch_url, url): key for key, url in jobs}
+                for future in tqdm(as_completed(futures), total=len(futures), leave=False):
+                    key = futures[future]
+                    batchdf = future.result()
+                    if key in merged:
+                        merged[key] = merged[key].merge(batchdf, on=Query.GEO_FIELDS, how='outer')
+                    else:
+                        merged[key] = batchdf
+
+        dfs = []
+        for q, query in enumerate(queries):
+            columns = query.raw_columns()
+            if q not in raw:
+                batches = [merged[key] for key in sorted(merged) if key[0] == q]
+                # batches arrive in any order, the columns should not
+                raw[q] = pd.concat(batches)[columns] if batches else pd.DataFrame(columns=columns)
+                if self.cache is not None:
+                    self.cache.put(query.cache_key(), raw[q])
+            dfs.append(query.process(raw[q][columns]))
+        return dfs
+
+    def _debug(self, message):
+        if self.logger:
+            self.logger.debug(message)
+
+
 class CensusData:
     DATA_SOURCE = "2021/acs/acs5"
     BLOCK_GROUP_YEAR = "2021"
 
-    def __init__(self, census_boundaries_file, tables_file, groupings_file = None, logger=None):
+    def __init__(self, census_boundaries_file, tables_file, groupings_file = None, logger=None, fetcher=None, base_url=CENSUS_API_URL, offline=False, bbox=None):
         self.tables_file = tables_file
         self.groupings_file = groupings_file
+        self.base_url = base_url
 
         self.tract_list = defaultdict(list)
         self.location_list = {}
         self.data = pd.DataFrame(columns=Query.GEO_FIELDS)
 
-        self.census_boundaries_gdf = gpd.read_file(census_boundaries_file)
+        # only the block groups around bbox (usually the stops) are read from the converted boundaries
+        self.census_boundaries_gdf = BoundaryStore(census_boundaries_file, logger=logger).read(bbox)
         self.census_boundaries_spatial_index = self.census_boundaries_gdf.sindex
 
         self.logger = logger
+        self.fetcher = fetcher or CensusFetcher(cache=census_cache(offline), logger=logger)
+
+    @property
+    def block_group_areas(self):
+        """
+        area in square meters of every block group, each measured in the UTM zone it sits in
+        """
+        if "block_group_area" not in self.census_boundaries_gdf.columns:
+            self.census_boundaries_gdf["block_group_area"] = utm_areas(self.census_boundaries_gdf)
+        return self.census_boundaries_gdf["block_group_area"]
 
     def location_request(self, point):
         possible_matches_index = list(self.census_boundaries_spatial_index.intersection(point.bounds))
@@ -140,19 +302,13 @@ class CensusData:
         if precise_matches.empty:
             return None
         
-        median_lat = precise_matches.geometry.centroid.y.median()
-        median_lon = precise_matches.geometry.centroid.x.median()
-        _, _, utm_zone, _ = utm.from_latlon(median_lat, median_lon)
-        print(f'EPSG:{32600 + utm_zone}')
-        precise_matches["block_group_area"] = precise_matches.to_crs(f'EPSG:{32600 + utm_zone}' ).area
-        
         match = precise_matches.iloc[0]
 
         state_code = match["STATEFP"]
         county_code = match["COUNTYFP"]
         tract_code = match["TRACTCE"]
         block_code = match["BLKGRPCE"]
-        bg_area = match["block_group_area"]
+        bg_area = self.block_group_areas.loc[precise_matches.index[0]]
         return state_code, county_code, tract_code, block_code, bg_area
         
     
@@ -166,50 +322,137 @@ class CensusData:
         self.location_list[(latitude, longitude)] = (state_code, county_code, tract_code, block_code[-1], area)
 
     def add_locations_from_geodataframe(self, gdf):
-        for _, point in tqdm(gdf.geometry.items(), total=len(gdf.geometry)):
-            if (point.y, point.x) not in self.location_list:
-                self.add_location(point)
+        """
+        resolves every new point of gdf to its block group with a single spatial join
+        """
+        points = gpd.GeoDataFrame({"latitude": gdf.geometry.y.to_numpy(), "longitude": gdf.geometry.x.to_numpy()}, geometry=gdf.geometry.values, crs=self.census_boundaries_gdf.crs)
+        points = points.drop_duplicates(["latitude", "longitude"])
+        already_added = pd.Series([location in self.location_list for location in zip(points.latitude, points.longitude)], index=points.index, dtype=bool)
+        points = points[~already_added]
+        if points.empty:
+            return
+
+        matches = self._match_block_groups(points)
+        self.location_list.update(zip(
+            zip(matches.latitude, matches.longitude),
+            zip(matches.STATEFP, matches.COUNTYFP, matches.TRACTCE, matches.BLKGRPCE.str[-1], matches.block_group_area)
+        ))
+        self._add_tracts(matches)
+
+    def _match_block_groups(self, points):
+        """
+        the first block group each point of points falls in, points outside all of them are dropped
+        """
+        boundaries = self.census_boundaries_gdf[["STATEFP", "COUNTYFP", "TRACTCE", "BLKGRPCE", "geometry"]].assign(block_group_area=self.block_group_areas)
+        matches = gpd.sjoin(points, boundaries, how="inner", predicate="intersects")
+        matches = matches[~matches.index.duplicated(keep="first")]
+
+        if len(matches) < len(points):
+            self._debug(f"{len(points) - len(matches)} locations are outside the census boundaries, skipping them")
+        return matches
+
+    def _add_tracts(self, matches):
+        for (state_code, county_code), tracts in matches.groupby(["STATEFP", "COUNTYFP"]).TRACTCE:
+            known = set(self.tract_list[(state_code, county_code)])
+            self.tract_list[(state_code, county_code)].extend(t for t in tracts.unique() if t not in known)
+
+    def block_group_features(self, gdf, download=False):
+        """
+        census data for every row of gdf, indexed like gdf. Points are resolved to block group keys,
+        every unique block group is looked up once and its row broadcast to the points by position.
+        Points outside the boundaries or without data get NaN.
+        """
+        points = gpd.GeoDataFrame(geometry=gdf.geometry.values, index=pd.RangeIndex(len(gdf)), crs=self.census_boundaries_gdf.crs)
+        matches = self._match_block_groups(points)
+        self._add_tracts(matches)
+        if download:
+            self.download_data()
+
+        keys = pd.Series(list(zip(matches.STATEFP.astype(int), matches.COUNTYFP.astype(int), matches.TRACTCE.astype(int), matches.BLKGRPCE.str[-1].astype(int))), index=matches.index)
+        block_group_codes, block_groups = pd.factorize(keys)
+        block_group_positions = np.array([self.data_positions.get(key, -1) for key in block_groups], dtype=np.int64)
+
+        positions = np.full(len(gdf), -1, dtype=np.int64)
+        positions[matches.index.to_numpy()] = block_group_positions[block_group_codes]
+        areas = np.full(len(gdf), np.nan)
+        areas[matches.index.to_numpy()] = matches.block_group_area.to_numpy()
+        areas[positions == -1] = np.nan
+
+        # position -1 is not a row, reindex fills it with NaN
+        features = self.data.reset_index(drop=True).reindex(positions)
+        features = features.drop(columns=["block_group_area", "geometry"], errors="ignore")
+        features["block_group_area"] = areas
+        features.index = gdf.index
+        return features
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._data_positions = None
+
+    @staticmethod
+    def block_group_key(state_code, county_code, tract_code, block_code):
+        return (int(state_code), int(county_code), int(tract_code), int(block_code))
+
+    @property
+    def data_positions(self):
+        """
+        (state, county, tract, block group) -> row position in data, the first row if repeated
+        """
+        if self._data_positions is None:
+            keys = zip(*(self.data[field].astype(int) for field in Query.GEO_FIELDS))
+            self._data_positions = {}
+            for position, key in enumerate(keys):
+                self._data_positions.setdefault(key, position)
+        return self._data_positions
 
     def lookup_location(self, point: Point):
         longitude, latitude = point.x, point.y
         if (latitude, longitude) not in self.location_list:
             self._debug(f"Location {(latitude, longitude)} not found, adding this location.")
-            self.add_location(latitude, longitude)
+            self.add_location(point)
             self.download_data()
 
         state_code, county_code, tract_code, block_code, bg_area =  self.location_list[(latitude, longitude)]
-        df = self.data[(self.data.state == int(state_code)) & (self.data.county == int(county_code)) & (self.data.tract == int(tract_code)) & (self.data['block group'] == int(block_code))]
-        return df.iloc[0].to_dict()
+        position = self.data_positions[CensusData.block_group_key(state_code, county_code, tract_code, block_code)]
+        return self.data.iloc[position].to_dict()
     
     def get_all_location_data(self, download=False):
+        """
+        one row per location that has census data, joined on the block group key in one merge
+        """
         if download:
             self.download_data()
 
-        dfs = []
-        for (latitude, longitude) in self.location_list:
-            state_code, county_code, tract_code, block_code, bg_area =  self.location_list[(latitude, longitude)]
-            df = self.data[(self.data.state == int(state_code)) & (self.data.county == int(county_code)) & (self.data.tract == int(tract_code)) & (self.data['block group'] == int(block_code))]
-            df["block_group_area"] = bg_area
-            if 'geometry' not in df.columns:
-                df['geometry'] = Point(longitude, latitude)
-            dfs.append(df)
-        
-        return gpd.GeoDataFrame(pd.concat(dfs))
+        locations = pd.DataFrame(
+            [CensusData.block_group_key(*codes[:4]) + (codes[4], Point(longitude, latitude)) for (latitude, longitude), codes in self.location_list.items()],
+            columns=Query.GEO_FIELDS + ["block_group_area", "geometry"]
+        )
+        data = self.data.astype({field: int for field in Query.GEO_FIELDS})
+        df = locations.merge(data.drop(columns=["block_group_area", "geometry"], errors="ignore"), on=Query.GEO_FIELDS, how="inner")
+        df = df[list(data.columns.drop(["block_group_area", "geometry"], errors="ignore")) + ["block_group_area", "geometry"]]
+        return gpd.GeoDataFrame(df)
          
     
     def download_data(self):
-        dfs = []
-        for (state_code, county_code) in tqdm(self.tract_list):
-            query = Query(CensusData.DATA_SOURCE, state_code, county_code, self.logger)
+        """
+        all counties are fetched together so their requests share the worker pool
+        """
+        queries = []
+        for (state_code, county_code) in self.tract_list:
+            query = Query(CensusData.DATA_SOURCE, state_code, county_code, self.logger, self.base_url)
             query.add_tables_from_yaml(self.tables_file)
             if self.groupings_file:
                 query.add_groupings_from_yaml(self.groupings_file)
             for tract in self.tract_list[(state_code, county_code)]:
                 query.add_tract(tract)
+            queries.append(query)
 
-            dfs.append(query.get())
-
-        self.data = pd.concat(dfs)
+        self.data = pd.concat(self.fetcher.fetch(queries))
         
     def _debug(self, message):
         if self.logger:
@@ -1,11 +1,14 @@
 import ast
-from collections import defaultdict
 from sqlalchemy import create_engine
 from pathlib import Path
 from typing import Union
-from lib.census import CensusData
+from lib.census import CensusData, CENSUS_CACHE_MAX_AGE_SECONDS
 from lib.queries import delay_query
-from lib.osm import OpenStreetMapsData
+from lib.osm import OpenStreetMapsData, osm_cache, POI_CATEGORIES, OSM_CACHE_MAX_AGE_SECONDS
+from lib.cache import DiskCache, fingerprint
+from lib.boundaries import BoundaryStore
+from lib.spatial import CoordinateStore, StopIndex, nearest_distances
+from lib.profiler import BuildProfiler
 from shapely import from_wkt
 import numpy as np
 import geopandas as gpd
@@ -22,8 +25,28 @@ logging.basicConfig(level=logging.DEBUG)
 pd.options.mode.chained_assignment = None 
 tqdm.pandas()
 
+GTFS_COLUMNS = {
+    "trips": ["trip_id", "route_id", "service_id"],
+    "stop_times": ["trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time"]
+}
+# block groups are read for the stop extent plus this much on every side
+CENSUS_BBOX_MARGIN_DEGREES = 0.02
+
+# 1: graph.json and csv attribute tables, 2: graph.npz (CSR) and parquet attribute tables
+DATASET_FORMAT_VERSION = 2
+
+# build stages are cached by a hash of their inputs, shared by every dataset and kept across saves
+STAGE_CACHE_VERSION = 2
+STAGE_CACHE_FOLDER = "cache/stages"
+STAGE_CACHE_MAX_BYTES = 4 << 30
+
+
+def stage_cache(max_age_seconds=None):
+    # entries carry their creation time, so caches with different ages can share the folder
+    return DiskCache(STAGE_CACHE_FOLDER, max_age_seconds, STAGE_CACHE_MAX_BYTES)
+
 class Dataset:
-    def __init__(self, name, gtfs_zip_filename, census_boundaries_file, nearby_stop_threshold = 200, nearby_poi_threshold = 400, census_tables_and_groupings = ("lib/census_tables.yaml", "lib/census_groupings.yaml"), num_trip_samples=5, save_folder = None, include_delay=False, delay_sqlite_db_str = None, delay_max = 30, already_built=False, include_census=True, only_during_peak=True):
+    def __init__(self, name, gtfs_zip_filename, census_boundaries_file, nearby_stop_threshold = 200, nearby_poi_threshold = 400, census_tables_and_groupings = ("lib/census_tables.yaml", "lib/census_groupings.yaml"), num_trip_samples=5, save_folder = None, include_delay=False, delay_sqlite_db_str = None, delay_max = 30, already_built=False, include_census=True, only_during_peak=True, stream_stop_times=False, service_date=None, day_type=None, offline=False, osm_extract_file=None, osm_tile_degrees=None):
         print(gtfs_zip_filename)
         if num_trip_samples % 2 == 0:
             assert Exception("num_trip_sampels must be odd number")
@@ -43,16 +66,16 @@ class Dataset:
 
         self.name = name
         self.gtfs_source = gtfs_zip_filename
-        self.stops, self.trips, self.stop_times, self.routes = util.load_gtfs_zip(gtfs_zip_filename)
-        self.stops_data = self.stops.copy().set_index('stop_id', drop=False)
+        self._feed = None
+        self._stops_data = None
+        self._cosine_latitude = None
+        self._stop_index = None
+        self._osm = None
+        self._census = None
 
-        self.osm = OpenStreetMapsData(self.stops_data.stop_lat.min(), self.stops_data.stop_lon.min(), self.stops_data.stop_lat.max(), self.stops_data.stop_lon.max(), logger=self.logger)
-        self.cosine_latitude = np.cos(self.stops_data.stop_lat.median())
-        
         self.include_census = include_census
-        census_tables, census_groupings = census_tables_and_groupings
+        self.census_tables_file, self.census_groupings_file = census_tables_and_groupings
         self.census_boundaries_file = census_boundaries_file
-        self.census = CensusData(self.census_boundaries_file, census_tables, census_groupings, logger=self.logger)
         
         self.nearby_stop_threshold = nearby_stop_threshold
         self.nearby_poi_threshold = nearby_poi_threshold
@@ -62,13 +85,85 @@ class Dataset:
         self.delay_sqlite_db_str = delay_sqlite_db_str if delay_sqlite_db_str else ""
         self.delay_max = delay_max
         self.only_during_peak = only_during_peak 
+        self.stream_stop_times = stream_stop_times
+        self.service_date = util.normalize_service_date(service_date)
+        self.day_type = day_type
+        # build from the osm and census caches only, failing on anything not cached
+        self.offline = offline
+        self.osm_extract_file = osm_extract_file
+        self.osm_tile_degrees = osm_tile_degrees
 
         self.G = nx.DiGraph()
 
         self.poi_names = []
+        self.pois = {}
 
         self.built = already_built
 
+    # The feed, census boundaries and OSM client are only needed while building,
+    # so they are loaded on first access rather than in __init__ (Dataset.load never touches them)
+    def _load_feed(self):
+        if self._feed is None:
+            self._feed = util.load_gtfs_zip(self.gtfs_source, columns=GTFS_COLUMNS, include_stop_times=not self.stream_stop_times, service_date=self.service_date, day_type=self.day_type)
+        return self._feed
+
+    @property
+    def stops(self):
+        return self._load_feed()[0]
+
+    @property
+    def trips(self):
+        return self._load_feed()[1]
+
+    @property
+    def stop_times(self):
+        return self._load_feed()[2]
+
+    @property
+    def routes(self):
+        return self._load_feed()[3]
+
+    @property
+    def stops_data(self):
+        if self._stops_data is None:
+            self._stops_data = self.stops.copy().set_index('stop_id', drop=False)
+        return self._stops_data
+
+    @stops_data.setter
+    def stops_data(self, stops_data):
+        self._stops_data = stops_data
+        self._stop_index = None
+
+    @property
+    def stop_index(self):
+        if self._stop_index is None:
+            self._stop_index = StopIndex(CoordinateStore(self.stops_data.geometry, self.cosine_latitude))
+        return self._stop_index
+
+    @property
+    def cosine_latitude(self):
+        if self._cosine_latitude is None:
+            self._cosine_latitude = np.cos(self.stops_data.stop_lat.median())
+        return self._cosine_latitude
+
+    @cosine_latitude.setter
+    def cosine_latitude(self, cosine_latitude):
+        self._cosine_latitude = cosine_latitude
+
+    @property
+    def osm(self):
+        if self._osm is None:
+            self._osm = OpenStreetMapsData(self.stops_data.stop_lat.min(), self.stops_data.stop_lon.min(), self.stops_data.stop_lat.max(), self.stops_data.stop_lon.max(), logger=self.logger, cache=osm_cache(self.offline), extract_file=self.osm_extract_file, tile_degrees=self.osm_tile_degrees)
+        return self._osm
+
+    @property
+    def census(self):
+        if self._census is None:
+            bbox = self.stops_data.stop_lon.min(), self.stops_data.stop_lat.min(), self.stops_data.stop_lon.max(), self.stops_data.stop_lat.max()
+            bbox = (bbox[0] - CENSUS_BBOX_MARGIN_DEGREES, bbox[1] - CENSUS_BBOX_MARGIN_DEGREES, bbox[2] + CENSUS_BBOX_MARGIN_DEGREES, bbox[3] + CENSUS_BBOX_MARGIN_DEGREES)
+            self._census = CensusData(self.census_boundaries_file, self.census_tables_file, self.census_groupings_file, logger=self.logger, offline=self.offline, bbox=bbox)
+        return self._census
+
     @property
     def info(self):
         return {
@@ -79,8 +174,9 @@ class Dataset:
             "poi_names": self.poi_names,
             "nearby_poi_threshold": self.nearby_poi_threshold,
             "nearby_stop_threshold": self.nearby_stop_threshold,
-            "census_tables_file": self.census.tables_file,
-            "census_groupings_file": self.census.groupings_file,
+            "census_tables_file": self.census_tables_file,
+            "census_groupings_file": self.census_groupings_file,
+            "cosine_latitude": self.cosine_latitude,
             "delay_sqlite_db_str": self.delay_sqlite_db_str,
             "delay_max": self.delay_max,
             "built": self.built,
@@ -88,7 +184,13 @@ class Dataset:
             "only_during_peak": self.only_during_peak,
             "census_boundaries_file": self.census_boundaries_file,
             "include_census": self.include_census,
-            "only_during_peak": self.only_during_peak
+            "only_during_peak": self.only_during_peak,
+            "stream_stop_times": self.stream_stop_times,
+            "service_date": self.service_date,
+            "day_type": self.day_type,
+            "osm_extract_file": self.osm_extract_file,
+            "osm_tile_degrees": self.osm_tile_degrees,
+            "format_version": DATASET_FORMAT_VERSION
         }
 
     @property
@@ -106,31 +208,36 @@ class Dataset:
         with open(folder / "dataset_info.json") as f:
             dataset_info = json.load(f)
         
-        with open(folder / "graph.json") as f:
-            graph = json.load(f)
-        
-        dataset = Dataset(dataset_info["name"], dataset_info["gtfs_source"], dataset_info["census_boundaries_file"], dataset_info["nearby_stop_threshold"], dataset_info["nearby_poi_threshold"], (dataset_info["census_tables_file"], dataset_info["census_groupings_file"]), dataset_info["num_trip_samples"], dataset_info["save_folder"], dataset_info["include_delay"], dataset_info["delay_sqlite_db_str"], dataset_info["delay_max"], dataset_info["built"], dataset_info["include_census"], dataset_info["only_during_peak"])
-        dataset.G = nx.node_link_graph(graph)
-
-        dataset.node_attributes = pd.read_csv(folder / "node_attribtes.csv", index_col=0, dtype=util.DATA_TYPES).drop_duplicates()
-        try:
-            dataset.node_attributes =  dataset.node_attributes.set_index('stop_id', drop=False)
-        except:
-            dataset.node_attributes["stop_id"] = dataset.node_attributes.index
-
-        dataset.node_attributes.geometry = dataset.node_attributes.geometry.apply(from_wkt)
-        dataset.node_attributes = gpd.GeoDataFrame(dataset.node_attributes, geometry="geometry")
-
-        def load_route_list(s):
-            try:
-                return ast.literal_eval(s)
-            except:
-                return []
-            
-        dataset.node_attributes.routes = dataset.node_attributes.routes.apply(load_route_list)
-        dataset.edge_attributes = pd.read_csv(folder / "edge_attributes.csv", index_col=[0,1], dtype=util.EDGE_DATA_TYPES).drop_duplicates()
-        edge_pairs = list(zip(dataset.edge_attributes.source_stop_id, dataset.edge_attributes.destination_stop_id))
-        dataset.edge_attributes = dataset.edge_attributes.set_index(pd.MultiIndex.from_tuples(edge_pairs))
+        dataset = Dataset(
+            dataset_info["name"],
+            dataset_info["gtfs_source"],
+            dataset_info.get("census_boundaries_file"),
+            nearby_stop_threshold=dataset_info["nearby_stop_threshold"],
+            nearby_poi_threshold=dataset_info["nearby_poi_threshold"],
+            census_tables_and_groupings=(dataset_info["census_tables_file"], dataset_info["census_groupings_file"]),
+            num_trip_samples=dataset_info["num_trip_samples"],
+            save_folder=dataset_info["save_folder"],
+            include_delay=dataset_info["include_delay"],
+            delay_sqlite_db_str=dataset_info["delay_sqlite_db_str"],
+            delay_max=dataset_info["delay_max"],
+            already_built=dataset_info["built"],
+            include_census=dataset_info.get("include_census", True),
+            only_during_peak=dataset_info.get("only_during_peak", True),
+            stream_stop_times=dataset_info.get("stream_stop_times", False),
+            service_date=dataset_info.get("service_date"),
+            day_type=dataset_info.get("day_type"),
+            osm_extract_file=dataset_info.get("osm_extract_file"),
+            osm_tile_degrees=dataset_info.get("osm_tile_degrees")
+        )
+        dataset.poi_names = dataset_info.get("poi_names", [])
+
+        if dataset_info.get("format_version", 1) >= 2:
+            dataset._load_tables(folder)
+        else:
+            dataset._load_legacy_tables(folder)
+
+        # datasets saved before cosine_latitude was recorded: the node attributes hold the same stops as the feed
+        dataset.cosine_latitude = dataset_info.get("cosine_latitude", np.cos(dataset.node_attributes.stop_lat.median()))
         return dataset
    
     
@@ -143,108 +250,258 @@ class Dataset:
         except Exception as e:
             self._debug(f"Could not copy over gtfs zip, skipping: {e}")
 
+        labels, offsets, indices = Dataset._graph_to_csr(self.G)
+        np.savez(folder / "graph.npz", labels=labels, offsets=offsets, indices=indices)
+
+        node_attributes = gpd.GeoDataFrame(self.node_attributes.drop_duplicates(), geometry="geometry")
+        node_attributes["routes"] = Dataset._routes_to_lists(node_attributes["routes"])
+        node_attributes.to_parquet(folder / "nodes.parquet", index=False)
+
+        edge_attributes = self.edge_attributes.drop_duplicates()
+        edge_attributes = edge_attributes.assign(routes=Dataset._routes_to_lists(edge_attributes["routes"]))
+        edge_attributes.to_parquet(folder / "edges.parquet", index=False)
+
+        # last, so a save that fails part way never leaves a folder claiming a format its tables aren't in
         util.export_json(self.info, folder / "dataset_info.json")
-        util.export_json(nx.node_link_data(self.G), folder / "graph.json")
-        self.node_attributes.drop_duplicates().to_csv(folder / "node_attribtes.csv")
-        self.edge_attributes.drop_duplicates().to_csv(folder / "edge_attributes.csv")
-        
 
-        for file_path in folder.glob("*"):
-            if file_path.is_file() and file_path.suffix == ".cache":
-                file_path.unlink() 
+    def _load_tables(self, folder):
+        """
+        the current format: column reads only, geometry as WKB and routes as list columns
+        """
+        with np.load(folder / "graph.npz") as graph:
+            self.G = Dataset._graph_from_csr(graph["labels"], graph["offsets"], graph["indices"])
+
+        self.node_attributes = gpd.read_parquet(folder / "nodes.parquet").set_index("stop_id", drop=False)
+        self.node_attributes["routes"] = Dataset._routes_from_lists(self.node_attributes["routes"])
+
+        self.edge_attributes = pd.read_parquet(folder / "edges.parquet")
+        self.edge_attributes.index = pd.MultiIndex.from_arrays([self.edge_attributes.source_stop_id, self.edge_attributes.destination_stop_id], names=[None, None])
+        self.edge_attributes["routes"] = Dataset._routes_from_lists(self.edge_attributes["routes"])
+
+    def _load_legacy_tables(self, folder):
+        """
+        datasets saved before format_version 2: node-link graph.json and csv attributes
+        """
+        with open(folder / "graph.json") as f:
+            self.G = nx.node_link_graph(json.load(f))
+
+        self.node_attributes = pd.read_csv(folder / "node_attribtes.csv", index_col=0, dtype=util.DATA_TYPES).drop_duplicates()
+        try:
+            self.node_attributes =  self.node_attributes.set_index('stop_id', drop=False)
+        except:
+            self.node_attributes["stop_id"] = self.node_attributes.index
+
+        self.node_attributes.geometry = self.node_attributes.geometry.apply(from_wkt)
+        self.node_attributes = gpd.GeoDataFrame(self.node_attributes, geometry="geometry")
+
+        self.node_attributes["routes"] = Dataset._routes_from_strings(self.node_attributes["routes"])
+        self.edge_attributes = pd.read_csv(folder / "edge_attributes.csv", index_col=[0,1], dtype=util.EDGE_DATA_TYPES).drop_duplicates()
+        edge_pairs = list(zip(self.edge_attributes.source_stop_id, self.edge_attributes.destination_stop_id))
+        self.edge_attributes = self.edge_attributes.set_index(pd.MultiIndex.from_tuples(edge_pairs))
+        self.edge_attributes["routes"] = Dataset._routes_from_strings(self.edge_attributes["routes"])
+
+    @staticmethod
+    def _graph_to_csr(G):
+        """
+        node labels plus the successors of node i as indices[offsets[i]:offsets[i + 1]], in adjacency order
+        """
+        labels = list(G.nodes)
+        positions = {label: position for position, label in enumerate(labels)}
+        lengths = np.fromiter((len(G.adj[label]) for label in labels), dtype=np.int64, count=len(labels))
+        offsets = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        indices = np.fromiter((positions[v] for label in labels for v in G.adj[label]), dtype=np.int64, count=offsets[-1])
+        return np.array(labels, dtype=str), offsets, indices
+
+    @staticmethod
+    def _graph_from_csr(labels, offsets, indices):
+        labels = labels.tolist()
+        G = nx.DiGraph()
+        G.add_nodes_from(labels)
+        sources = np.repeat(np.arange(len(labels)), np.diff(offsets))
+        G.add_edges_from(zip(np.take(labels, sources).tolist(), np.take(labels, indices).tolist()))
+        return G
+
+    @staticmethod
+    def _routes_to_lists(routes):
+        # stops no repeated edge passes through have no routes
+        return pd.Series([list(r) if isinstance(r, (tuple, list, set)) else None for r in routes], index=routes.index, dtype=object)
+
+    @staticmethod
+    def _routes_from_lists(routes):
+        # tuples like the ones _link_routes builds, so the columns stay hashable for drop_duplicates
+        return pd.Series([tuple(r) if r is not None else () for r in routes], index=routes.index, dtype=object)
+
+    @staticmethod
+    def _routes_from_strings(routes):
+        # format 1 csvs hold the repr of each route tuple, and nothing for stops without routes
+        def parse(s):
+            try:
+                return tuple(ast.literal_eval(s))
+            except (ValueError, SyntaxError, TypeError):
+                return ()
+        return pd.Series([parse(s) for s in routes], index=routes.index, dtype=object)
 
 
     def _build(self, override_if_already_built = False, use_cache = True, save_folder: Union[str, Path] = None):
         if self.built and not override_if_already_built:
             raise Exception("Dataset already built and override set to false. If you'd like to force a rebuild, set override to true")
         
+        profiler = BuildProfiler(self.name)
         with tqdm(total=4, desc="build progress") as pbar:
             self._debug("\nStep 1: Downloading OSM Data")
-            
-            if use_cache:
-                _, info_ok = self._from_json_cache("dataset_info")
-                stops_data, osm_ok =  self._from_csv_cache("osm_stops_data")
-            if use_cache and info_ok and osm_ok:
-                self.stops_data = stops_data
-                self._debug("Loaded OSM from cache")
-            else:
-                self._download_osm_data()
-                self._apply_poi_thresholds()
-                self._to_json_cache("dataset_info", self.info)
-                self._to_csv_cache("osm_stops_data", self.stops_data)
+            with profiler.stage("download_osm_data") as stage:
+                self.pois = self._cached_stage("osm", self._stage_inputs("osm"), use_cache, self._download_osm_data, stage)
+                stage["rows"] = sum(len(pois) for pois in self.pois.values())
+            self.poi_names = list(self.pois.keys())
+            with profiler.stage("apply_poi_thresholds") as stage:
+                poi_columns = self._cached_stage("poi_thresholds", self._stage_inputs("poi_thresholds"), use_cache, self._apply_poi_thresholds, stage)
+                stage["rows"] = len(poi_columns)
+            self.stops_data = self.stops_data.drop(columns=poi_columns.columns, errors="ignore").join(poi_columns)
             pbar.update(1)
 
             if self.include_census:
                 self._debug("\nStep 2: Adding Census Data")
-
-                if use_cache:
-                    stops_data, census_ok = self._from_csv_cache("all_stops_data")
-                
-                if self.include_census and use_cache and census_ok:
-                    self.stops_data = stops_data
-                    self._debug("Loaded Census info cache")
-                elif self.include_census:
-                    self._add_census_data()
-                    self._to_csv_cache("all_stops_data", self.stops_data)
+                with profiler.stage("add_census_data") as stage:
+                    census_columns = self._cached_stage("census", self._stage_inputs("census"), use_cache, self._add_census_data, stage)
+                    stage["rows"] = len(census_columns)
+                self.stops_data = self.stops_data.drop(columns=census_columns.columns, errors="ignore").join(census_columns)
             pbar.update(1)
 
 
             if self.include_delay:
                 self._debug("\nStep 3: Adding Delay Data")
-                
-                if use_cache:
-                    delay_df, delay_ok =  self._from_csv_cache("delay_df")
-                
-                if use_cache and delay_ok:
-                    self.delay_df = delay_df
-                    self._debug("Loaded Delay info cache")
-                else:
-                    self._download_delay_info()
-                    self._to_csv_cache("delay_df", self.delay_df)
+                with profiler.stage("download_delay_info") as stage:
+                    raw_delay, self.delay_df = self._cached_stage("delay", self._stage_inputs("delay"), use_cache, self._download_delay_info, stage)
+                    self._write_delay_files(raw_delay)
+                    stage["rows"] = len(self.delay_df)
             pbar.update(1)
 
 
             self._debug("\nStep 4: Linking Routes")
-            self._link_routes()
+            with profiler.stage("link_routes") as stage:
+                edge_attributes, stop_routes, random_state = self._cached_stage("linking", self._stage_inputs("linking"), use_cache, self._link_routes_stage, stage)
+                stage["rows"] = len(edge_attributes)
+            # the same graph _link_routes builds, and random left where linking leaves it since it draws the sampled trips
+            random.setstate(random_state)
+            self.G = nx.DiGraph()
+            self.G.add_nodes_from(self.stops_data.stop_id)
+            self.G.add_edges_from(edge_attributes.index)
+            self.stops_data["routes"] = stop_routes
+            self.node_attributes = self.stops_data
+            self.edge_attributes = edge_attributes
             pbar.update(1)
             
-            self.save(save_folder)
-            self._debug("Saved to " + str(self.save_folder))
+            folder = Path(save_folder) if save_folder else self.save_folder
+            with profiler.stage("save") as stage:
+                self.save(folder)
+                stage["rows"] = len(self.node_attributes) + len(self.edge_attributes)
+            self._debug("Saved to " + str(folder))
+
+            for regression in profiler.save(folder):
+                self._debug(f"Build regression in {regression['stage']}: {regression['metric']} went from {regression['previous']:.6g} to {regression['current']:.6g}")
+
+    def _stage_inputs(self, stage):
+        """
+        everything a build stage's output depends on, the stage cache key
+        """
+        feed = {
+            "feed": util.FEED_CACHE.content_hash(self.gtfs_source),
+            "service_date": self.service_date,
+            "day_type": self.day_type
+        }
+        osm = {**feed, "osm_source": fingerprint(self.osm_extract_file) or "overpass", "categories": POI_CATEGORIES}
+        delay = {
+            **feed,
+            "delay_db": fingerprint(self.delay_sqlite_db_str),
+            "delay_query": delay_query(self.only_during_peak),
+            "delay_max": self.delay_max
+        }
 
+        if stage == "osm":
+            return osm
+        if stage == "poi_thresholds":
+            return {**osm, "nearby_poi_threshold": self.nearby_poi_threshold, "cosine_latitude": self.cosine_latitude}
+        if stage == "census":
+            return {
+                **feed,
+                "boundaries": BoundaryStore(self.census_boundaries_file).stamp,
+                "tables": fingerprint(self.census_tables_file),
+                "groupings": fingerprint(self.census_groupings_file),
+                "data_source": CensusData.DATA_SOURCE
+            }
+        if stage == "delay":
+            return delay
+        if stage == "linking":
+            return {
+                **feed,
+                "delay": delay if self.include_delay else None,
+                "random_state": random.getstate()
+            }
+        raise Exception(f"Unknown build stage {stage}")
+
+    def _stage_max_age(self, stage):
+        """
+        stages built from a live api expire with that api's cache, the key can't tell a newer response apart
+        """
+        if stage in ("osm", "poi_thresholds") and not self.osm_extract_file:
+            return OSM_CACHE_MAX_AGE_SECONDS
+        if stage == "census":
+            return CENSUS_CACHE_MAX_AGE_SECONDS
+        return None
+
+    def _cached_stage(self, name, inputs, use_cache, run, profile = None):
+        """
+        the output of run, or of an earlier run with the same inputs. whether it was cached is recorded in profile
+        """
+        key = {"stage": name, "version": STAGE_CACHE_VERSION, "inputs": inputs}
+        cache = stage_cache(self._stage_max_age(name))
+        if profile is not None:
+            profile["cached"] = False
+        if use_cache:
+            output = cache.get(key)
+            if output is not None:
+                self._debug(f"Loaded {name} from the stage cache")
+                if profile is not None:
+                    profile["cached"] = True
+                return output
+
+        output = run()
+        cache.put(key, output)
+        return output
+
+    def _link_routes_stage(self):
+        self._link_routes()
+        return self.edge_attributes, self.stops_data["routes"], random.getstate()
 
     def _download_osm_data(self):
-        pois = [
-            ("hospital", self.osm.find_hospitals()),
-            ("grocery", self.osm.find_grocery_store()),
-            ("park", self.osm.find_parks()),
-            ("bar", self.osm.find_bars()),
-            ("worship", self.osm.find_worship()),
-            ("mcdonalds", self.osm.find_mcdonalds()),
-            ("starbucks", self.osm.find_starbucks())
-        ]
-
-        self.poi_names = [name for (name, _) in pois]
-
-        for poi_name, poi_gdf in tqdm(pois, desc="join osm data"):
-            self._debug("joining data for: " + poi_name)
-            self.stops_data[f"closest_{poi_name}_distance"] = self.stops_data.geometry.apply(lambda p: util.find_closest(p, poi_gdf.geometry, self.cosine_latitude)[1])
+        return self.osm.find_categories()
 
     def _apply_poi_thresholds(self):
-        for poi_name in tqdm(self.poi_names, desc="apply poi thresholds"):
-            self.stops_data[f"near_{poi_name}"] = self.stops_data[f"closest_{poi_name}_distance"] <= self.nearby_poi_threshold
+        """
+        distance to the closest poi of every category, how many are within nearby_poi_threshold and whether any is
+        """
+        poi_columns = pd.DataFrame(index=self.stops_data.index)
+        for poi_name, poi_gdf in tqdm(self.pois.items(), desc="join osm data"):
+            self._debug("joining data for: " + poi_name)
+            poi_geometry = poi_gdf.geometry if "geometry" in poi_gdf.columns else None
+            distances, counts = nearest_distances(self.stops_data.geometry, poi_geometry, self.cosine_latitude, self.nearby_poi_threshold)
+            poi_columns[f"closest_{poi_name}_distance"] = distances
+            poi_columns[f"nearby_{poi_name}_count"] = counts
+
+        for poi_name in self.poi_names:
+            poi_columns[f"near_{poi_name}"] = poi_columns[f"closest_{poi_name}_distance"] <= self.nearby_poi_threshold
+        return poi_columns
     
     def _add_census_data(self):
-        self.census.add_locations_from_geodataframe(self.stops_data)
-        census_data = self.census.get_all_location_data(download=True)
-        self.stops_data =  self.stops_data.merge(census_data, on="geometry", how="left")
+        return self.census.block_group_features(self.stops_data, download=True)
 
     def _download_delay_info(self):
         conn = create_engine(f"sqlite:///{self.delay_sqlite_db_str}")
 
         self.delay_df = pd.read_sql_query(delay_query(self.only_during_peak), conn, dtype=util.DELAY_DATA_TYPES)
         self.delay_df.minute_delay = self.delay_df.minute_delay.clip(0, self.delay_max)
-        
-        self.delay_df.drop_duplicates().to_csv(self.save_folder / "raw_delay.csv")        
+        raw_delay = self.delay_df.drop_duplicates()
         
         self.delay_df = self.delay_df.groupby(['stop_id', 'trip_sequence']).agg({
             'trip_id': 'first',
@@ -257,118 +514,121 @@ class Dataset:
             'planned_arrival_seconds_since_midnight': ['max', 'min']}).reset_index()
 
         self.delay_df.columns = self.delay_df.columns.to_flat_index().map(lambda x: x[0]+"_"+x[1] if x[1] == 'max' or x[1] == 'min' else x[0])
-        
-        self.delay_df.drop_duplicates().to_csv(self.save_folder / "grouped_delay.csv")        
+        return raw_delay, self.delay_df
+
+    def _write_delay_files(self, raw_delay):
+        # DelayDataset.add_std_column regroups raw_delay.csv, written on stage cache hits too
+        raw_delay.to_csv(self.save_folder / "raw_delay.csv")
+        self.delay_df.drop_duplicates().to_csv(self.save_folder / "grouped_delay.csv")
   
+    def _sample_trips(self):
+        """
+        one random trip per route, returns the stop times of the sampled trips (with route_id) and the sampled trip ids
+        """
+        if not self.stream_stop_times:
+            stop_times = self.stop_times.merge(self.trips[["trip_id","route_id"]], on="trip_id", how="left")
+            stop_times.route_id = stop_times.route_id.astype(str)
+            sampled_trips = Dataset._choose_trips(stop_times[["trip_id", "route_id"]].drop_duplicates("trip_id"))
+            return stop_times[stop_times.trip_id.isin(sampled_trips)], sampled_trips
+
+        # Same sampling as above without holding the timetable: trips are taken in the order
+        # they first appear in stop_times.txt, so a fixed seed samples the same trips
+        service_trip_ids = self.trips.trip_id if (self.service_date or self.day_type) else None
+        trip_routes = pd.DataFrame({"trip_id": util.stop_times_trip_order(self.gtfs_source, trip_ids=service_trip_ids)})
+        trip_routes = trip_routes.merge(self.trips[["trip_id","route_id"]], on="trip_id", how="left")
+        trip_routes.route_id = trip_routes.route_id.astype(str)
+        sampled_trips = Dataset._choose_trips(trip_routes)
+
+        stop_times = util.read_stop_times(self.gtfs_source, columns=GTFS_COLUMNS["stop_times"], trip_ids=sampled_trips)
+        stop_times = stop_times.merge(self.trips[["trip_id","route_id"]], on="trip_id", how="left")
+        stop_times.route_id = stop_times.route_id.astype(str)
+        return stop_times, sampled_trips
+
+    @staticmethod
+    def _choose_trips(trip_routes):
+        """
+        trip_routes has one row per trip in the order trips first appear, routes are visited in the order they
+        first appear and one trip is drawn per route with random.choice over the route's trips in that order
+        """
+        trips_by_route = trip_routes.groupby("route_id", sort=False).trip_id.agg(list)
+        return [random.choice(trip_ids) for trip_ids in trips_by_route]
+
     def _link_routes(self):
+        """
+        edges between consecutive stops of the sampled trips. driving_time is the first hop's time for edges seen once,
+        otherwise the running average kept in trip order (which leaves out the first hop), routes lists the route of every hop
+        and stops only get the routes of edges seen more than once
+        """
         self.G = nx.DiGraph()
-        trips = self.trips.copy()
-        stop_times = self.stop_times.copy()
+        stop_times, sampled_trips = self._sample_trips()
+        self.G.add_nodes_from(self.stops_data.stop_id)
+
+        # every hop between consecutive stops, trips in sampled order and stops in stop_sequence order
+        trip_order = pd.Series(np.arange(len(sampled_trips)), index=pd.Index(sampled_trips, dtype=object))
+        stop_times = pd.DataFrame({
+            "trip": stop_times.trip_id.astype(object).map(trip_order).to_numpy(),
+            "stop_id": stop_times.stop_id.astype(object).to_numpy(),
+            "stop_sequence": stop_times.stop_sequence.to_numpy(),
+            "arrival_time": stop_times.arrival_time.to_numpy(dtype=float),
+            "departure_time": stop_times.departure_time.to_numpy(dtype=float),
+            "route_id": stop_times.route_id.to_numpy()
+        })
+        stop_times = stop_times.iloc[np.lexsort((stop_times.stop_sequence.to_numpy(), stop_times.trip.to_numpy()))]
+        same_trip = stop_times.trip.shift() == stop_times.trip
+        stop_times["prev_stop_id"] = stop_times.stop_id.shift()
+        stop_times["prev_departure_time"] = stop_times.departure_time.shift()
+        hops = stop_times[same_trip & (stop_times.prev_stop_id != stop_times.stop_id)]
+
+        driving_times = ((hops.arrival_time - hops.prev_departure_time) / util.SECONDS_TO_MINUTES).to_numpy()
+        edge_codes, edges = pd.factorize(pd.MultiIndex.from_arrays([hops.prev_stop_id, hops.stop_id]))
+        occurrence = hops.groupby(edge_codes).cumcount().to_numpy() + 1
+
+        # replays the running average one occurrence rank at a time, so values match it to the last bit
+        edge_driving_times = np.empty(len(edges))
+        first = occurrence == 1
+        edge_driving_times[edge_codes[first]] = driving_times[first]
+        for update_count in range(1, occurrence.max(initial=1)):
+            later = occurrence == update_count + 1
+            edge_driving_times[edge_codes[later]] = (1/update_count) * driving_times[later] + (1 - 1/update_count) * edge_driving_times[edge_codes[later]]
+
+        self.edge_attributes = pd.DataFrame({
+            "update_count": np.bincount(edge_codes, minlength=len(edges)),
+            "driving_time": edge_driving_times,
+            "routes": hops.groupby(edge_codes).route_id.agg(tuple).to_numpy(),
+            "source_stop_id": edges.get_level_values(0),
+            "destination_stop_id": edges.get_level_values(1)
+        }, index=pd.MultiIndex.from_tuples(list(edges)))
+
+        if self.include_delay:
+            last = ~pd.Series(edge_codes).duplicated(keep="last").to_numpy()
+            self._add_edge_delays(hops[last].iloc[np.argsort(edge_codes[last])])
+
+        self.G.add_edges_from(edges)
+
+        # a set per stop filled in hop order, so the tuples come out exactly as from the running version
+        repeats = hops[occurrence > 1]
+        stop_routes = pd.DataFrame({
+            "stop_id": np.column_stack([repeats.prev_stop_id, repeats.stop_id]).ravel(),
+            "route_id": np.repeat(repeats.route_id.to_numpy(), 2)
+        })
+        stops_to_routes = stop_routes.groupby("stop_id", sort=False).route_id.agg(lambda routes: tuple(set(routes)))
+        self.stops_data["routes"] = stops_to_routes
 
-        stop_times = stop_times.merge(trips[["trip_id","route_id"]], on="trip_id", how="left")
-   
-        sampled_trips = []
-        stop_times.route_id = stop_times.route_id.astype(str)
-        for route_id in stop_times.route_id.unique():
-            sampled_trips.append(random.choice(stop_times.trip_id[stop_times.route_id == route_id].unique()))
-            
-        
-        stop_times = stop_times[stop_times.trip_id.isin(sampled_trips)]
-       
-        edge_info = {}
-        stops_to_routes = defaultdict(set)
-
-        for stop_id in self.stops_data.stop_id:
-            self.G.add_node(stop_id)
-
-        for trip_id in tqdm(sampled_trips, desc="linking trips"):
-            trip_stop_times = stop_times[stop_times.trip_id == trip_id].sort_values('stop_sequence').reset_index()
-
-            if len(trip_stop_times) < 2:
-                continue
-
-            assert len(trip_stop_times.route_id.unique()) == 1
-            route_id = trip_stop_times.route_id.iloc[0]
-
-            # Iterate through the stop times for the current trip
-            for i in tqdm(range(1, len(trip_stop_times)), leave=False):
-
-                stop_id = trip_stop_times.stop_id.iloc[i]
-                prev_stop_id = trip_stop_times.stop_id.iloc[i - 1]
-
-                if prev_stop_id == stop_id:
-                    continue
-
-                cur_driving_time = (trip_stop_times.arrival_time.iloc[i] - trip_stop_times.departure_time.iloc[i - 1]) / util.SECONDS_TO_MINUTES
-
-                edge = (prev_stop_id, stop_id)
-                
-                if not self.G.has_edge(*edge):
-                    self.G.add_edge(*edge)
-                    edge_info[edge] = {
-                        "update_count": 1,
-                        "driving_time": cur_driving_time,
-                        "routes": [route_id]
-                    }
-                        
-                else:
-                    update_count = edge_info[edge]["update_count"]
-                    prev_driving_time = edge_info[edge]["driving_time"]
-                    
-                    edge_info[edge]["update_count"] = update_count + 1
-                    edge_info[edge]["driving_time"] = (1/update_count) * cur_driving_time + (1 - 1/update_count) * prev_driving_time
-                    edge_info[edge]["routes"].append(route_id)
-                    
-                    stops_to_routes[prev_stop_id].add(route_id)
-                    stops_to_routes[stop_id].add(route_id) 
-                
-                edge_info[edge]["source_stop_id"] = prev_stop_id
-                edge_info[edge]["destination_stop_id"] = stop_id
-
-                if self.include_delay:
-                    delay_info = self.delay_df[(self.delay_df.stop_id == stop_id) & (self.delay_df.trip_sequence == trip_stop_times.stop_sequence.iloc[i])]
-                    avg_delay = np.nan if delay_info.empty else delay_info.minute_delay.iloc[0]
-                    delay_std = np.nan if (delay_info.empty or 'minute_delay_std' not in delay_info.columns) else delay_info.minute_delay_std.iloc[0]
-                    edge_info[edge]["avg_delay"] = avg_delay
-                    edge_info[edge]["delay_std"] = delay_std
-
-
-                    
-        for edge in edge_info:
-            edge_info[edge]["routes"] = tuple(edge_info[edge]["routes"])
-
-        stops_to_routes = {k:tuple(v) for k,v in stops_to_routes.items()}
-        self.stops_data["routes"] = pd.Series(stops_to_routes)
-        
         self.node_attributes = self.stops_data
-        self.edge_attributes = pd.DataFrame(edge_info.values(), index=pd.MultiIndex.from_tuples(edge_info.keys()))
 
+    def _add_edge_delays(self, last_hops):
+        """
+        delay of every edge from its last hop, last_hops has one row per edge in edge order.
+        Joined on (stop_id, trip_sequence) in one merge, taking the first delay row per key
+        """
+        delay_columns = [c for c in ["minute_delay", "minute_delay_std"] if c in self.delay_df.columns]
+        delays = self.delay_df[["stop_id", "trip_sequence"] + delay_columns].drop_duplicates(["stop_id", "trip_sequence"])
+        keys = pd.DataFrame({"stop_id": last_hops.stop_id.to_numpy(), "trip_sequence": last_hops.stop_sequence.to_numpy()})
+        joined = keys.merge(delays, on=["stop_id", "trip_sequence"], how="left")
 
-    def _to_json_cache(self, name, obj):
-        util.export_json(obj, self.save_folder / (name + ".json.cache"))
+        self.edge_attributes["avg_delay"] = joined.minute_delay.to_numpy()
+        self.edge_attributes["delay_std"] = joined.minute_delay_std.to_numpy() if "minute_delay_std" in joined.columns else np.nan
 
-    
-    def _to_csv_cache(self, name, df):
-        df.to_csv(self.save_folder / (name + ".csv.cache"))
-
-    def _from_json_cache(self, name):
-        if not Path(self.save_folder / (name + ".json.cache")).is_file():
-            return None, False
-         
-        with open(self.save_folder / (name + ".json.cache")) as f:
-            return json.load(f), True
-
-    def _from_csv_cache(self, name):
-        if not Path(self.save_folder / (name + ".csv.cache")).is_file():
-            return None, False
-        
-        df = pd.read_csv(self.save_folder / (name + ".csv.cache"), dtype=util.DATA_TYPES)
-        if "geometry" not in df.columns:
-            return df, True
-        
-        df.geometry = df.geometry.apply(from_wkt)
-        gdf = gpd.GeoDataFrame(df, geometry="geometry")
-        return gdf, True
 
     def _debug(self, *messages):
         message = " ".join([str(m) for m in messages])
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+import pandas as pd
+import pyarrow.parquet as pq
+
+FEED_CACHE_FOLDER = Path("cache/feeds")
+HASH_CHUNK_BYTES = 1 << 20
+ROW_GROUP_ROWS = 500_000
+
+
+class FeedCache:
+    """
+    Parsed GTFS tables stored as parquet, one folder per (zip content hash, loader version)
+    """
+    TABLES = ("stops", "trips", "stop_times", "routes")
+
+    def __init__(self, folder = FEED_CACHE_FOLDER, loader_version = 1):
+        self.folder = Path(folder)
+        self.loader_version = loader_version
+        self._digests = {}
+
+    def content_hash(self, gtfs_zip_filename):
+        path = Path(gtfs_zip_filename).resolve()
+        stat = path.stat()
+        memo_key = (str(path), stat.st_size, stat.st_mtime_ns)
+
+        if memo_key not in self._digests:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+                    digest.update(chunk)
+            self._digests[memo_key] = digest.hexdigest()
+
+        return self._digests[memo_key]
+
+    def key(self, gtfs_zip_filename):
+        return f"{self.content_hash(gtfs_zip_filename)}-v{self.loader_version}"
+
+    def contains(self, key):
+        return (self.folder / key / "manifest.json").is_file()
+
+    def columns(self, key, table):
+        with open(self.folder / key / "manifest.json") as f:
+            return json.load(f)["columns"][table]
+
+    def read(self, key, table, columns = None, filters = None):
+        if columns is not None:
+            available = self.columns(key, table)
+            columns = [c for c in available if c in set(columns)]
+        return pd.read_parquet(self.folder / key / f"{table}.parquet", columns=columns, filters=filters)
+
+    def iter_batches(self, key, table, columns = None, batch_size = 500_000):
+        if columns is not None:
+            available = self.columns(key, table)
+            columns = [c for c in available if c in set(columns)]
+        parquet_file = pq.ParquetFile(self.folder / key / f"{table}.parquet")
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
+
+    def write(self, key, tables, source = None):
+        destination = self.folder / key
+        staging = self.folder / f"{key}.tmp-{os.getpid()}"
+        staging.mkdir(parents=True, exist_ok=True)
+
+        for table in FeedCache.TABLES:
+            tables[table].to_parquet(staging / f"{table}.parquet", index=False, row_group_size=ROW_GROUP_ROWS)
+
+        manifest = {
+            "source": str(source) if source else None,
+            "loader_version": self.loader_version,
+            "columns": {table: list(tables[table].columns) for table in FeedCache.TABLES}
+        }
+        with open(staging / "manifest.json", "w+") as f:
+            json.dump(manifest, f)
+
+        # another process may have finished the same feed first, theirs is just as good
+        try:
+            staging.rename(destination)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
@@ -29,7 +29,7 @@ def decrease_route_frequency(bps, route_id, by_minutes):
 
 def replace_stop(bps, route_id, stop_idx, new_stop):    
     old_stop = bps.routes_to_stops[route_id][stop_idx]
-    nearby_stops = bps.node_attributes[util.find_all_within(bps.node_attributes.geometry.loc[old_stop], bps.node_attributes.geometry, radius_meters, bps.cosine_latitude)].index
+    nearby_stops = bps.node_attributes[util.find_all_within(bps.node_attributes.geometry.loc[old_stop], bps.node_attributes.geometry, radius_meters, bps.cosine_latitude, spatial_index=bps.stop_index)].index
 
     bps.replace_ith_stop_on_route(stop_idx, route_id, new_stop)
     description = f"On route {route_id}, replaced stop {old_stop} {bps.node_attributes.loc[old_stop].stop_name} with {new_stop} {bps.node_attributes.loc[new_stop].stop_name}"
@@ -41,7 +41,7 @@ def replace_stop(bps, route_id, stop_idx, new_stop):
 
 def add_stop(bps, route_id, stop_idx, new_stop):    
     current_stop = bps.routes_to_stops[route_id][stop_idx]
-    nearby_stops = bps.node_attributes[util.find_all_within(bps.node_attributes.geometry.loc[current_stop], bps.node_attributes.geometry, 2400, bps.cosine_latitude)].index
+    nearby_stops = bps.node_attributes[util.find_all_within(bps.node_attributes.geometry.loc[current_stop], bps.node_attributes.geometry, 2400, bps.cosine_latitude, spatial_index=bps.stop_index)].index
 
     bps.insert_ith_stop_on_route(stop_idx, route_id, new_stop)
     description = f"On route {route_id}, added stop {new_stop} {bps.node_attributes.loc[new_stop].stop_name}"
@@ -1,5 +1,4 @@
 import random
-import lib.util as util
 
 def increase_random_route_frequency(bps, by_minutes: int = 5):
     route_options = list(bps.routes_to_stops.keys())
@@ -37,8 +36,7 @@ def replace_random_stop(bps, radius_meters: int = 2400):
     random_idx = random.choice(range(len(bps.routes_to_stops[random_route])))
     
     old_stop = bps.routes_to_stops[random_route][random_idx]
-    nearby_stops = bps.node_attributes[util.find_all_within(bps.node_attributes.geometry.loc[old_stop], bps.node_attributes.geometry, radius_meters, bps.cosine_latitude)].index
-    random_new_stop = random.choice(nearby_stops)
+    random_new_stop = bps.random_nearby_stop(old_stop, radius_meters)
 
     bps.replace_ith_stop_on_route(random_idx, random_route, random_new_stop)
     description = f"On route {random_route}, replaced stop {old_stop} {bps.node_attributes.loc[old_stop].stop_name} with {random_new_stop} {bps.node_attributes.loc[random_new_stop].stop_name} in radius {radius_meters}"
@@ -54,8 +52,7 @@ def add_random_stop(bps, radius_meters: int = 2400):
     random_idx = random.choice(range(len(bps.routes_to_stops[random_route])))
     
     current_stop = bps.routes_to_stops[random_route][random_idx]
-    nearby_stops = bps.node_attributes[util.find_all_within(bps.node_attributes.geometry.loc[current_stop], bps.node_attributes.geometry, 2400, bps.cosine_latitude)].index
-    random_new_stop = random.choice(nearby_stops)
+    random_new_stop = bps.random_nearby_stop(current_stop, radius_meters)
 
     bps.insert_ith_stop_on_route(random_idx, random_route, random_new_stop)
     description = f"On route {random_route}, added stop {random_new_stop} {bps.node_attributes.loc[random_new_stop].stop_name} in radius {radius_meters}"
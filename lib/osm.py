@@ -1,22 +1,69 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+import time
+import requests
 import overpass
+import numpy as np
+import pandas as pd
 import geopandas as gpd
 from tqdm import tqdm
 from shapely.geometry import Point
+from lib.cache import DiskCache
+from lib.retry import backoff_delay
+from lib.profiler import record_response
+
+OSM_CACHE_FOLDER = "cache/osm"
+OSM_CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+OSM_CACHE_MAX_BYTES = 1 << 30
+PBF_SUFFIXES = (".pbf", ".osm", ".bz2")
+# columns an exported extract may use for the node id
+OSM_ID_COLUMNS = ("osm_id", "id", "@id")
+
+# poi name -> (osm tag, value), the categories Dataset joins to stops
+POI_CATEGORIES = {
+    "hospital": ("amenity", "hospital"),
+    "grocery": ("shop", "supermarket"),
+    "park": ("leisure", "park"),
+    "bar": ("amenity", "bar"),
+    "worship": ("amenity", "place_of_worship"),
+    "mcdonalds": ("brand", "McDonald's"),
+    "starbucks": ("brand", "Starbucks")
+}
+
+
+def osm_cache(offline=False):
+    return DiskCache(OSM_CACHE_FOLDER, OSM_CACHE_MAX_AGE_SECONDS, OSM_CACHE_MAX_BYTES, offline)
+
+
+class OverpassAPI(overpass.API):
+    # overpass posts with requests directly, this sees each response before it's parsed to count its bytes
+    def _get_from_overpass(self, query):
+        response = super()._get_from_overpass(query)
+        record_response(response)
+        return response
 
 
 class OpenStreetMapsData:
-    def __init__(self, north_lat, west_lng, south_lat, east_lng, logger=None) -> None:
+    def __init__(self, north_lat, west_lng, south_lat, east_lng, logger=None, cache=None, extract_file=None, tile_degrees=None, max_workers=4, max_retries=3, backoff_seconds=5) -> None:
         self.bbox = f"{north_lat},{west_lng},{south_lat},{east_lng}"
-        self.api = overpass.API()
+        self.bounds = (float(north_lat), float(west_lng), float(south_lat), float(east_lng))
+        self.api = OverpassAPI()
         self.logger = logger
+        self.cache = cache
+        # a local extract (.osm.pbf, or pre-filtered GeoJSON/GeoParquet of nodes) replaces Overpass when given
+        self.extract_file = Path(extract_file) if extract_file else None
+        # with tile_degrees the bbox is queried as a grid of tiles, each cached on its own so a failed run resumes
+        self.tile_degrees = tile_degrees
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
 
     def find_parks(self,return_geodataframe=True):
-        query = f"""node["leisure"="park"]({self.bbox});"""
-        return self.find("grocery", query, return_geodataframe)
+        return self.find_tag("grocery", "leisure", "park", return_geodataframe)
     
     def find_grocery_store(self,return_geodataframe=True):
-        query = f"""node["shop"="supermarket"]({self.bbox});"""
-        return self.find("grocery", query, return_geodataframe)
+        return self.find_tag("grocery", "shop", "supermarket", return_geodataframe)
     
     def find_worship(self, return_geodataframe=True):
         return self.find_amenity("place_of_worship", return_geodataframe)
@@ -34,14 +81,163 @@ class OpenStreetMapsData:
         return self.find_brand("Starbucks", return_geodataframe)
     
     def find_brand(self, brand, return_geodataframe=True):
-        query = f"""node["brand"="{brand}"]({self.bbox});"""
-        return self.find(brand, query, return_geodataframe)
+        return self.find_tag(brand, "brand", brand, return_geodataframe)
     
     def find_amenity(self, amenity, return_geodataframe=True):
-        query = f"""node["amenity"="{amenity}"]({self.bbox});"""
-        return self.find(amenity, query, return_geodataframe)
+        return self.find_tag(amenity, "amenity", amenity, return_geodataframe)
+
+    def find_tag(self, name, tag, value, return_geodataframe=True):
+        if self.extract_file is not None:
+            results = self.read_extract({name: (tag, value)})[name]
+            return gpd.GeoDataFrame(results) if return_geodataframe else results
+
+        query = f"""node["{tag}"="{value}"]({self.bbox});"""
+        return self.find(name, query, return_geodataframe)
+
+    def find_categories(self, categories=POI_CATEGORIES, return_geodataframe=True):
+        """
+        every category of categories (name -> (tag, value)) from one union query over the bbox,
+        split locally by tag. A node matching several categories is in each of them, like separate queries.
+        The split results are cached by bbox and categories, per tile when tiling.
+        """
+        if self.extract_file is not None:
+            results = self.read_extract(categories)
+            if not return_geodataframe:
+                return results
+            return {name: gpd.GeoDataFrame(rows) for name, rows in results.items()}
+
+        tiles = self.tiles()
+        if len(tiles) == 1:
+            results = self._find_tile(tiles[0], categories)
+        else:
+            results = {name: {} for name in categories}
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(self._find_tile, tile, categories) for tile in tiles]
+                for future in tqdm(as_completed(futures), total=len(futures), desc="osm tiles", leave=False):
+                    # nodes on a shared tile edge come back from both tiles
+                    for name, rows in future.result().items():
+                        for row in rows:
+                            results[name].setdefault(row["osm_id"], row)
+            results = {name: list(rows.values()) for name, rows in results.items()}
+
+        if not return_geodataframe:
+            return results
+        return {name: gpd.GeoDataFrame(rows) for name, rows in results.items()}
+
+    def tiles(self):
+        """
+        the bbox split into a grid of at most tile_degrees sized boxes, as overpass bbox strings
+        """
+        if not self.tile_degrees:
+            return [self.bbox]
+
+        south, west, north, east = self.bounds
+        rows = max(1, int(np.ceil((north - south) / self.tile_degrees - 1e-9)))
+        columns = max(1, int(np.ceil((east - west) / self.tile_degrees - 1e-9)))
+        lats = np.linspace(south, north, rows + 1)
+        lons = np.linspace(west, east, columns + 1)
+        return [
+            f"{lats[i]:.6f},{lons[j]:.6f},{lats[i + 1]:.6f},{lons[j + 1]:.6f}"
+            for i in range(rows) for j in range(columns)
+        ]
+
+    def _find_tile(self, bbox, categories):
+        cache_key = {"bbox": bbox, "categories": categories}
+        results = self.cache.get(cache_key) if self.cache is not None else None
+        if results is not None:
+            self._debug(f"Loaded OSM categories {list(categories)} for {bbox} from cache")
+            return results
+
+        query = "(" + "".join(f"""node["{tag}"="{value}"]({bbox});""" for (tag, value) in categories.values()) + ");"
+        for attempt in range(self.max_retries + 1):
+            try:
+                elements = self.find("combined", query, return_geodataframe=False, include_tags=True)
+                break
+            except (overpass.OverpassError, requests.RequestException) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(self.backoff_seconds, attempt)
+                self._debug(f"OSM query for {bbox} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+        results = {}
+        for name, (tag, value) in categories.items():
+            results[name] = [
+                {**{k: v for k, v in element.items() if k != "tags"}, "osm_query": name}
+                for element in elements if element["tags"].get(tag) == value
+            ]
+
+        if self.cache is not None:
+            self.cache.put(cache_key, results)
+        return results
+
+    def read_extract(self, categories):
+        """
+        nodes of the local extract inside the bbox, split into categories (name -> (tag, value))
+        in one pass over the file, with the same rows find returns
+        """
+        self._debug(f"Reading OSM extract {self.extract_file} for {list(categories)}")
+        if self.extract_file.name.endswith(PBF_SUFFIXES):
+            return self._read_pbf(categories)
+        return self._read_vector_extract(categories)
+
+    def _in_bbox(self, lat, lon):
+        south, west, north, east = self.bounds
+        return south <= lat <= north and west <= lon <= east
+
+    def _read_pbf(self, categories):
+        try:
+            import osmium
+        except ImportError as e:
+            raise Exception(f"Reading the .pbf extract {self.extract_file} requires the optional osmium package (pip install osmium), "
+                            "or pass a GeoJSON/GeoParquet extract instead") from e
+
+        results = defaultdict(list)
+        osm_data = self
+
+        class PoiHandler(osmium.SimpleHandler):
+            def node(self, n):
+                if not n.location.valid() or not osm_data._in_bbox(n.location.lat, n.location.lon):
+                    return
+                for name, (tag, value) in categories.items():
+                    if n.tags.get(tag) == value:
+                        results[name].append({
+                            'osm_id': n.id,
+                            'osm_name': n.tags.get('name', 'Unknown Name'),
+                            'geometry': Point(n.location.lon, n.location.lat),
+                            'osm_query': name
+                        })
+
+        PoiHandler().apply_file(str(self.extract_file))
+        return {name: results[name] for name in categories}
+
+    def _read_vector_extract(self, categories):
+        south, west, north, east = self.bounds
+        if self.extract_file.suffix == ".parquet":
+            gdf = gpd.read_parquet(self.extract_file)
+            gdf = gdf.cx[west:east, south:north]
+        else:
+            gdf = gpd.read_file(self.extract_file, bbox=(west, south, east, north))
+        gdf = gdf[gdf.geom_type == "Point"]
+        gdf = gdf[gdf.geometry.y.between(south, north) & gdf.geometry.x.between(west, east)]
+
+        id_column = next((c for c in OSM_ID_COLUMNS if c in gdf.columns), None)
+        ids = gdf[id_column] if id_column else pd.Series(gdf.index, index=gdf.index)
+        names = gdf["name"].fillna("Unknown Name") if "name" in gdf.columns else pd.Series("Unknown Name", index=gdf.index)
+
+        results = {}
+        for name, (tag, value) in categories.items():
+            if tag not in gdf.columns:
+                results[name] = []
+                continue
+            matching = (gdf[tag] == value).to_numpy()
+            results[name] = [
+                {'osm_id': osm_id, 'osm_name': osm_name, 'geometry': geometry, 'osm_query': name}
+                for osm_id, osm_name, geometry in zip(ids[matching], names[matching], gdf.geometry[matching])
+            ]
+        return results
 
-    def find(self, name, query, return_geodataframe=True):
+    def find(self, name, query, return_geodataframe=True, include_tags=False):
         self._debug("Performing OSM Query: " + query)
         response = self.api.Get(query)
         
@@ -53,6 +249,8 @@ class OpenStreetMapsData:
                 'geometry': Point(element['geometry']['coordinates'][0], element['geometry']['coordinates'][1]),
                 'osm_query': name
             })
+            if include_tags:
+                results[-1]['tags'] = element['properties']
 
         if not return_geodataframe:
             return results
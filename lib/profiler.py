@@ -0,0 +1,161 @@
+import contextlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+import psutil
+
+REPORT_FILENAME = "build_report.json"
+PREVIOUS_REPORT_FILENAME = "build_report.previous.json"
+# a stage is a regression when it takes this much more time or memory than in the previous report
+REGRESSION_RATIO = 1.25
+# and at least this much in absolute terms, so tiny stages don't flag on noise
+REGRESSION_MIN_SECONDS = 1
+REGRESSION_MIN_BYTES = 64 << 20
+
+# bytes sent and received by the fetchers of this process, stages read them as deltas.
+# parallel builds run in their own processes, so each only counts its own requests
+_network_lock = threading.Lock()
+_network_bytes = [0, 0]
+
+
+def record_network_bytes(sent, received):
+    with _network_lock:
+        _network_bytes[0] += sent
+        _network_bytes[1] += received
+
+
+def record_response(response, *args, **kwargs):
+    """
+    counts the url and body of a requests response's request and the body it got back, usable as a session response hook
+    """
+    body = response.request.body or b""
+    sent = len(response.request.url) + len(body.encode() if isinstance(body, str) else body)
+    record_network_bytes(sent, len(response.content))
+
+
+def network_bytes():
+    with _network_lock:
+        return tuple(_network_bytes)
+
+
+class PeakMemorySampler:
+    """
+    samples the rss of this process on a background thread and keeps the peak
+    """
+    def __init__(self, process, interval_seconds = 0.1):
+        self.process = process
+        self.interval_seconds = interval_seconds
+        self.peak_rss = process.memory_info().rss
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+
+class BuildProfiler:
+    """
+    Wall time, cpu time, peak rss, row counts and network bytes per build stage.
+    Network bytes are the request and response bodies the fetchers report through record_response, headers not included.
+    """
+    def __init__(self, name, sample_interval_seconds = 0.1):
+        self.name = name
+        self.sample_interval_seconds = sample_interval_seconds
+        self.process = psutil.Process(os.getpid())
+        self.stages = []
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        profiles the body of the with block, the yielded dict takes extra fields such as rows or cached
+        """
+        stage = {"name": name}
+        sent_before, received_before = network_bytes()
+        cpu_before = self.process.cpu_times()
+        wall_before = time.perf_counter()
+        try:
+            with PeakMemorySampler(self.process, self.sample_interval_seconds) as sampler:
+                yield stage
+        finally:
+            cpu_after = self.process.cpu_times()
+            sent_after, received_after = network_bytes()
+            stage.update({
+                "wall_seconds": time.perf_counter() - wall_before,
+                "cpu_seconds": (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system),
+                "peak_rss_bytes": sampler.peak_rss,
+                "network_bytes_sent": sent_after - sent_before,
+                "network_bytes_received": received_after - received_before
+            })
+            self.stages.append(stage)
+
+    @property
+    def report(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "wall_seconds": sum(stage["wall_seconds"] for stage in self.stages),
+            "cpu_seconds": sum(stage["cpu_seconds"] for stage in self.stages),
+            "peak_rss_bytes": max((stage["peak_rss_bytes"] for stage in self.stages), default=0),
+            "stages": self.stages
+        }
+
+    def save(self, folder):
+        """
+        writes the report into folder, keeping the one it replaces as the previous report,
+        and returns the regressions against it
+        """
+        folder = Path(folder)
+        report = self.report
+        previous = load_report(folder / REPORT_FILENAME)
+        report["regressions"] = compare_reports(report, previous) if previous else []
+
+        if previous:
+            shutil.copy2(folder / REPORT_FILENAME, folder / PREVIOUS_REPORT_FILENAME)
+        with open(folder / REPORT_FILENAME, "w+") as f:
+            json.dump(report, f, indent=2)
+        return report["regressions"]
+
+
+def load_report(filename):
+    filename = Path(filename)
+    if filename.is_dir():
+        filename = filename / REPORT_FILENAME
+    if not filename.is_file():
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def compare_reports(current, previous, ratio = REGRESSION_RATIO):
+    """
+    stages of current that took ratio times the wall time, cpu time or peak rss they took in previous
+    """
+    previous_stages = {stage["name"]: stage for stage in previous.get("stages", [])}
+    regressions = []
+    for stage in current.get("stages", []):
+        before = previous_stages.get(stage["name"])
+        if before is None or before.get("cached") != stage.get("cached"):
+            continue
+        for metric, minimum in [("wall_seconds", REGRESSION_MIN_SECONDS), ("cpu_seconds", REGRESSION_MIN_SECONDS), ("peak_rss_bytes", REGRESSION_MIN_BYTES)]:
+            if stage[metric] > before[metric] * ratio and stage[metric] - before[metric] >= minimum:
+                regressions.append({
+                    "stage": stage["name"],
+                    "metric": metric,
+                    "previous": before[metric],
+                    "current": stage[metric]
+                })
+    return regressions
@@ -0,0 +1,9 @@
+import random
+
+
+def backoff_delay(backoff_seconds, attempt):
+    """
+    seconds to wait before retry number attempt + 1: exponential backoff with jitter,
+    between half and all of backoff_seconds * 2 ** attempt
+    """
+    return backoff_seconds * 2 ** attempt * (1 + random.random()) / 2
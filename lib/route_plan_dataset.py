@@ -3,11 +3,15 @@ from pathlib import Path
 from typing import List, Union
 from lib.dataset import Dataset
 from lib.bus_plan_state import BusPlanState
+from lib.spatial import CoordinateStore, StopIndex, StopNeighbors
 import lib.util as util
 from shapely import Point
 import logging
 
 
+# radii the search actions draw replacement stops from
+NEIGHBOR_RADII = (800, 1600, 2400, 3200)
+
 class RoutePlanDataset(Dataset):
     @staticmethod
     def load(save_folder):
@@ -24,27 +28,40 @@ class RoutePlanDataset(Dataset):
         super()._build(override_if_already_built, use_cache, save_folder)
         self.built = True
     
+    @property
+    def stop_neighbors(self) -> StopNeighbors:
+        if getattr(self, "_stop_neighbors", None) is None:
+            node_index = StopIndex(CoordinateStore(self.node_attributes.geometry, self.cosine_latitude))
+            self._stop_neighbors = StopNeighbors.load_or_build(self.save_folder, node_index, NEIGHBOR_RADII)
+        return self._stop_neighbors
+
+    def _bus_plan_state(self, name, from_json = None) -> BusPlanState:
+        bps = BusPlanState(name, self.node_attributes, self.cosine_latitude, self.save_folder, from_json=from_json)
+        bps.stop_neighbors = self.stop_neighbors
+        return bps
+
     def get_original_bus_plan_state(self) -> BusPlanState:
         if Path(self.save_folder / "original.busplanstate.json").is_file():
             with open(Path(self.save_folder / "original.busplanstate.json")) as f:
                 data = json.load(f)
-            return BusPlanState("original", self.node_attributes, self.cosine_latitude, self.save_folder, from_json=data)
-        bps = BusPlanState.create_from_feed(self.gtfs_source, self.node_attributes, self.cosine_latitude, self.save_folder)
+            return self._bus_plan_state("original", from_json=data)
+        bps = BusPlanState.create_from_feed(self.gtfs_source, self.node_attributes, self.cosine_latitude, self.save_folder, stream_stop_times=self.stream_stop_times, service_date=self.service_date, day_type=self.day_type)
+        bps.stop_neighbors = self.stop_neighbors
         bps.save()
         return bps
     
     def load_bus_plan_state(self, name, filename) -> BusPlanState:
         with open(filename) as f:
             data = json.load(f)
-        return BusPlanState(name, self.node_attributes, self.cosine_latitude, self.save_folder, from_json=data)
+        return self._bus_plan_state(name, from_json=data)
     
     def get_blank_bus_plan_state(self, name) -> BusPlanState:
         if name == "original":
             raise Exception("You can name it anything but 'original'")
-        return BusPlanState(name, self.node_attributes, self.cosine_latitude, self.save_folder)
+        return self._bus_plan_state(name)
 
     def bus_route_weighting_function(self, bus_plan_state: BusPlanState, previous_edge, u, v):
-        driving_time = (1/util.AVG_BUS_SPEED_METERS_PER_MIN) * util.approx_manhattan_distance_in_meters(self.node_attributes.geometry.loc[u], self.node_attributes.geometry.loc[v], self.cosine_latitude) 
+        driving_time = bus_plan_state.coordinates.driving_time(u, v)
         common_routes = bus_plan_state.get_routes_in_common(previous_edge, (u,v))
         requires_transfer = (len(common_routes) == 0)
         return (
@@ -73,7 +90,7 @@ class RoutePlanDataset(Dataset):
             u,v = node_pair_list[i]
             previous_edge = node_pair_list[i-1] if i > 0 else None
 
-            driving_time = (1/util.AVG_BUS_SPEED_METERS_PER_MIN) * util.approx_manhattan_distance_in_meters(self.node_attributes.geometry.loc[u], self.node_attributes.geometry.loc[v], self.cosine_latitude) 
+            driving_time = bus_plan_state.coordinates.driving_time(u, v)
             common_routes = bus_plan_state.get_routes_in_common(previous_edge, (u,v))
             requires_transfer = (len(common_routes) == 0)
             slower_route_adjustment = min(0, bus_plan_state.get_overall_shortest_interval(common_routes) - bus_plan_state.get_min_wait_time_at_stop(u))
@@ -110,11 +127,11 @@ class RoutePlanDataset(Dataset):
         return result
 
     def get_route_from_points(self, bps: BusPlanState, origin: Point, destination: Point):
-        origin_stop_mask, _ = util.find_closest(origin, self.stops_data.geometry, self.cosine_latitude)
-        origin_stop_idx = self.stops_data.index.loc[origin_stop_mask]
+        origin_stop_position, _ = util.find_closest(origin, self.stops_data.geometry, self.cosine_latitude, spatial_index=self.stop_index)
+        origin_stop_idx = self.stops_data.index[origin_stop_position]
 
-        destination_stop_mask = util.find_all_within(destination, self.stops_data.geometry, util.WALKING_DISTANCE_METERS, self.cosine_latitude)
-        destination_stop_idxs = self.stops_data.index.loc[destination_stop_mask]
+        destination_stop_mask = util.find_all_within(destination, self.stops_data.geometry, util.WALKING_DISTANCE_METERS, self.cosine_latitude, spatial_index=self.stop_index)
+        destination_stop_idxs = self.stops_data.index[destination_stop_mask.to_numpy()]
 
         return util.multisource_dijkstra(bps.G, destination_stop_idxs, origin_stop_idx, weight_function= lambda previous_edge, u,v: self.bus_route_weighting_function(bps, previous_edge, u,v))
 
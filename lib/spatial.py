@@ -0,0 +1,249 @@
+import random
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from shapely import Point
+import lib.util as util
+
+
+def project(lons, lats, cosine_latitude: float):
+    """
+    lon/lat degrees to local meters, euclidean distance between projected points
+    is exactly util.approx_distance_in_meters
+    """
+    x = np.abs(cosine_latitude) * util.METERS_TO_DEGREE * np.asarray(lons, dtype=float)
+    y = util.METERS_TO_DEGREE * np.asarray(lats, dtype=float)
+    return x, y
+
+
+class CoordinateStore:
+    """
+    stop locations as contiguous float64 arrays in local meters plus a stop_id -> position map,
+    so distances between stops are plain array indexing instead of .loc lookups on shapely points
+    """
+    def __init__(self, geometry, cosine_latitude: float):
+        self.labels = geometry.index
+        self.cosine_latitude = cosine_latitude
+        x, y = project(geometry.x.to_numpy(), geometry.y.to_numpy(), cosine_latitude)
+        self.x, self.y = np.ascontiguousarray(x), np.ascontiguousarray(y)
+        self.positions = {label: position for position, label in enumerate(self.labels)}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def position(self, stop_id):
+        return self.positions[stop_id]
+
+    def positions_of(self, stop_ids):
+        return np.fromiter((self.positions[s] for s in stop_ids), dtype=np.int64)
+
+    def manhattan_distance(self, u, v):
+        # same value as util.approx_manhattan_distance_in_meters
+        pu, pv = self.positions[u], self.positions[v]
+        return abs(self.x[pu] - self.x[pv]) + abs(self.y[pu] - self.y[pv])
+
+    def manhattan_distances(self, us, vs):
+        pu, pv = self.positions_of(us), self.positions_of(vs)
+        return np.abs(self.x[pu] - self.x[pv]) + np.abs(self.y[pu] - self.y[pv])
+
+    def driving_time(self, u, v):
+        return self.manhattan_distance(u, v) / util.AVG_BUS_SPEED_METERS_PER_MIN
+
+    def driving_times(self, us, vs):
+        return self.manhattan_distances(us, vs) / util.AVG_BUS_SPEED_METERS_PER_MIN
+
+
+class StopIndex:
+    """
+    KD-tree over a CoordinateStore, queries return positions
+    into (or labels of) the geometry series the store was built from
+    """
+    def __init__(self, coordinates: CoordinateStore):
+        self.coordinates = coordinates
+        self.labels = coordinates.labels
+        self.cosine_latitude = coordinates.cosine_latitude
+        self.x, self.y = coordinates.x, coordinates.y
+        self.tree = cKDTree(np.column_stack([self.x, self.y]))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def project_point(self, point: Point):
+        x, y = project(point.x, point.y, self.cosine_latitude)
+        return float(x), float(y)
+
+    def positions_within(self, point: Point, distance_in_meters):
+        return np.sort(np.asarray(self.tree.query_ball_point(self.project_point(point), distance_in_meters), dtype=int))
+
+    def within(self, point: Point, distance_in_meters):
+        return self.labels[self.positions_within(point, distance_in_meters)]
+
+    def mask_within(self, point: Point, distance_in_meters):
+        mask = np.zeros(len(self.labels), dtype=bool)
+        mask[self.positions_within(point, distance_in_meters)] = True
+        return pd.Series(mask, index=self.labels)
+
+    def positions_near_segments(self, route_points, distance_in_meters):
+        """
+        positions of stops within distance_in_meters of any segment between consecutive route_points,
+        candidates come from a ball around each segment's midpoint and are then checked exactly
+        """
+        lons = np.array([p.x for p in route_points], dtype=float)
+        lats = np.array([p.y for p in route_points], dtype=float)
+        if len(lons) == 0:
+            return np.array([], dtype=int)
+        xs, ys = project(lons, lats, self.cosine_latitude)
+        if len(xs) == 1:
+            xs, ys = np.repeat(xs, 2), np.repeat(ys, 2)
+
+        ax, ay, bx, by = xs[:-1], ys[:-1], xs[1:], ys[1:]
+        midpoints = np.column_stack([(ax + bx) / 2, (ay + by) / 2])
+        radii = np.hypot(bx - ax, by - ay) / 2 + distance_in_meters
+
+        found = []
+        for i, candidates in enumerate(self.tree.query_ball_point(midpoints, radii)):
+            candidates = np.asarray(candidates, dtype=int)
+            if len(candidates) == 0:
+                continue
+            distances = util.segment_distances(self.x[candidates], self.y[candidates], ax[i], ay[i], bx[i], by[i])
+            found.append(candidates[distances <= distance_in_meters])
+
+        if not found:
+            return np.array([], dtype=int)
+        return np.unique(np.concatenate(found))
+
+    def near_segments(self, route_points, distance_in_meters):
+        return self.labels[self.positions_near_segments(route_points, distance_in_meters)]
+
+    def mask_near_segments(self, route_points, distance_in_meters):
+        mask = np.zeros(len(self.labels), dtype=bool)
+        mask[self.positions_near_segments(route_points, distance_in_meters)] = True
+        return pd.Series(mask, index=self.labels)
+
+    def nearest(self, point: Point, k = 1):
+        distances, positions = self.tree.query(self.project_point(point), k=k)
+        return np.atleast_1d(positions), np.atleast_1d(distances)
+
+    def closest(self, point: Point):
+        positions, distances = self.nearest(point, k=1)
+        return int(positions[0]), float(distances[0])
+
+
+class NeighborTable:
+    """
+    stops within radius_in_meters of every stop in CSR form: the neighbors of the stop at
+    position p are indices[offsets[p]:offsets[p + 1]], sorted, including p itself
+    """
+    def __init__(self, radius_in_meters, offsets, indices):
+        self.radius_in_meters = radius_in_meters
+        self.offsets = offsets
+        self.indices = indices
+
+    @staticmethod
+    def build(stop_index: StopIndex, radius_in_meters):
+        neighbor_lists = stop_index.tree.query_ball_point(np.column_stack([stop_index.x, stop_index.y]), radius_in_meters)
+        lengths = np.fromiter((len(n) for n in neighbor_lists), dtype=np.int64, count=len(neighbor_lists))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        indices = np.empty(offsets[-1], dtype=np.int32)
+        for position, neighbors in enumerate(neighbor_lists):
+            indices[offsets[position]:offsets[position + 1]] = np.sort(neighbors)
+        return NeighborTable(radius_in_meters, offsets, indices)
+
+    def neighbors(self, position):
+        return self.indices[self.offsets[position]:self.offsets[position + 1]]
+
+    def sample(self, position):
+        # randrange draws like random.choice does, so a fixed seed picks the same stop as
+        # random.choice over StopIndex.within
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return int(self.indices[start + random.randrange(end - start)])
+
+
+class StopNeighbors:
+    """
+    NeighborTables at several radii for one set of stops, saved next to a dataset as FILENAME
+    """
+    FILENAME = "stop_neighbors.npz"
+
+    def __init__(self, labels, cosine_latitude: float, tables):
+        self.labels = pd.Index(labels)
+        self.cosine_latitude = cosine_latitude
+        self.tables = tables
+        self.positions = {label: position for position, label in enumerate(self.labels)}
+
+    @property
+    def radii(self):
+        return list(self.tables.keys())
+
+    @staticmethod
+    def build(stop_index: StopIndex, radii):
+        tables = {radius: NeighborTable.build(stop_index, radius) for radius in radii}
+        return StopNeighbors(stop_index.labels, stop_index.cosine_latitude, tables)
+
+    def neighbors(self, label, radius_in_meters):
+        return self.labels[self.tables[radius_in_meters].neighbors(self.positions[label])]
+
+    def random_neighbor(self, label, radius_in_meters):
+        return self.labels[self.tables[radius_in_meters].sample(self.positions[label])]
+
+    def save(self, filename):
+        arrays = {
+            "labels": self.labels.to_numpy(dtype=str),
+            "cosine_latitude": np.array(self.cosine_latitude),
+            "radii": np.array(self.radii)
+        }
+        for radius, table in self.tables.items():
+            arrays[f"offsets_{radius}"] = table.offsets
+            arrays[f"indices_{radius}"] = table.indices
+        np.savez(filename, **arrays)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as arrays:
+            tables = {
+                radius.item(): NeighborTable(radius.item(), arrays[f"offsets_{radius}"], arrays[f"indices_{radius}"])
+                for radius in arrays["radii"]
+            }
+            return StopNeighbors(arrays["labels"], arrays["cosine_latitude"].item(), tables)
+
+    @staticmethod
+    def load_or_build(folder, stop_index: StopIndex, radii):
+        """
+        reuses the tables saved in folder when they cover the same stops and radii, otherwise rebuilds and saves them
+        """
+        filename = Path(folder) / StopNeighbors.FILENAME
+        if filename.is_file():
+            saved = StopNeighbors.load(filename)
+            same_stops = saved.labels.equals(pd.Index(stop_index.labels.to_numpy(dtype=str))) and saved.cosine_latitude == stop_index.cosine_latitude
+            if same_stops and set(radii) <= set(saved.radii):
+                saved.labels = stop_index.labels
+                saved.positions = {label: position for position, label in enumerate(saved.labels)}
+                return saved
+
+        stop_neighbors = StopNeighbors.build(stop_index, radii)
+        stop_neighbors.save(filename)
+        return stop_neighbors
+
+
+def nearest_distances(points, targets, cosine_latitude: float, radius_in_meters = None):
+    """
+    for every point in points (GeoSeries) the distance in meters to the closest of targets (GeoSeries),
+    and if radius_in_meters is given how many targets are within it (else None).
+    One KD-tree over the targets, queried for all points at once.
+    """
+    if targets is None or len(targets) == 0:
+        counts = np.zeros(len(points), dtype=int) if radius_in_meters is not None else None
+        return np.full(len(points), np.inf), counts
+
+    tx, ty = project(targets.x.to_numpy(), targets.y.to_numpy(), cosine_latitude)
+    px, py = project(points.x.to_numpy(), points.y.to_numpy(), cosine_latitude)
+    tree = cKDTree(np.column_stack([tx, ty]))
+    query_points = np.column_stack([px, py])
+
+    distances, _ = tree.query(query_points, k=1)
+    counts = None
+    if radius_in_meters is not None:
+        counts = np.asarray(tree.query_ball_point(query_points, radius_in_meters, return_length=True), dtype=int)
+    return distances, counts
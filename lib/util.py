@@ -6,11 +6,17 @@ from shapely import Point, LineString
 import geopandas as gpd
 import networkx as nx
 import heapq
+import logging
 from urllib.parse import urlencode, urlparse, parse_qs
 from urllib.request import urlopen, Request
 import contextily as ctx
 import matplotlib.pyplot as plt
 from matplotlib.cm import plasma  
+from lib.feed_cache import FeedCache, FEED_CACHE_FOLDER
+
+# bump whenever load_gtfs_zip output changes so cached feeds are re-parsed
+GTFS_LOADER_VERSION = 1
+FEED_CACHE = FeedCache(FEED_CACHE_FOLDER, GTFS_LOADER_VERSION)
 
 SECONDS_TO_MINUTES = 60
 FIVE_HOURS_IN_MINUTES = 5 * 60
@@ -21,6 +27,7 @@ STOP_PENALTY_MINUTES = 0.5
 DEFAULT_ROUTE_FREQUENCY_IN_MINS = 15
 NO_ROUTE_PENALTY = FIVE_HOURS_IN_MINUTES
 AVG_BUS_SPEED_METERS_PER_MIN = 833 #about 30mph
+STOP_TIMES_CHUNK_ROWS = 500_000
 
 METERS_TO_DEGREE = 111111 #https://gis.stackexchange.com/questions/2951/algorithm-for-offsetting-a-latitude-longitude-by-some-amount-of-meters
 COLORS = ['red', 'blue', 'green', 'purple', 'orange', 'brown', 'pink']
@@ -35,6 +42,36 @@ EDGE_DATA_TYPES = {
     'destination_stop_id': str
 }
 
+STOP_TIMES_DATA_TYPES = {
+    **DATA_TYPES,
+    'arrival_time': str,
+    'departure_time': str
+}
+
+STOP_TIMES_COLUMNS = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
+# dtypes of the columns read_stop_times returns, ids as strings and times as seconds since midnight
+STOP_TIMES_EMPTY_DTYPES = {
+    'trip_id': object,
+    'stop_id': object,
+    'arrival_time': float,
+    'departure_time': float,
+    'stop_sequence': 'int64'
+}
+
+CALENDAR_DATA_TYPES = {
+    'service_id': str,
+    'start_date': str,
+    'end_date': str,
+    'date': str
+}
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+DAY_TYPES = {
+    'weekday': WEEKDAYS[:5],
+    'weekend': WEEKDAYS[5:],
+    **{day: [day] for day in WEEKDAYS}
+}
+
 DELAY_DATA_TYPES = {
     'stop_id': str,
     'route_id': str,
@@ -46,20 +83,46 @@ def export_json(d, filename):
         json.dump(d, f)
 
 
-def find_all_within(origin: Point, options, distance_in_meters, cosine_latitude: float):
+def find_all_within(origin: Point, options, distance_in_meters, cosine_latitude: float, spatial_index = None):
+    """
+    spatial_index: optional lib.spatial.StopIndex built over options, answers the query from its KD-tree
+    """
+    if spatial_index is not None:
+        return spatial_index.mask_within(origin, distance_in_meters)
     distances = options.apply(lambda d: approx_distance_in_meters(origin, d, cosine_latitude))
     mask = distances <= distance_in_meters
     return mask
 
-def find_all_near_line(line1: Point, line2:Point, options, distance_in_meters, cosine_latitude: float):
-    distances = options.apply(lambda d: approx_euclidean_distance_to_line(d, line1, line2, cosine_latitude))
-    mask = distances <= distance_in_meters
-    return mask
-
-def find_closest(origin: Point, options, cosine_latitude: float):
+def find_all_near_line(line1: Point, line2:Point, options, distance_in_meters, cosine_latitude: float, spatial_index = None):
+    """
+    mask of options within distance_in_meters of the segment line1 -> line2,
+    spatial_index: optional lib.spatial.StopIndex built over options to prune candidates
+    """
+    if spatial_index is not None:
+        return spatial_index.mask_near_segments([line1, line2], distance_in_meters)
+    distances = approx_distance_to_segment_in_meters(options.x.to_numpy(), options.y.to_numpy(), line1.x, line1.y, line2.x, line2.y, cosine_latitude)
+    return pd.Series(distances <= distance_in_meters, index=options.index)
+
+def find_all_near_route(route_points, options, distance_in_meters, cosine_latitude: float, spatial_index = None):
+    """
+    mask of options within distance_in_meters of any segment between consecutive route_points (e.g. a route's stop geometries)
+    """
+    if spatial_index is not None:
+        return spatial_index.mask_near_segments(route_points, distance_in_meters)
+    route_points = list(route_points)
+    lons, lats = options.x.to_numpy(), options.y.to_numpy()
+    mask = np.zeros(len(options), dtype=bool)
+    # the first pair is the first point on its own, so single stop routes still match
+    for start, end in zip(route_points[:1] + route_points[:-1], route_points):
+        mask |= approx_distance_to_segment_in_meters(lons, lats, start.x, start.y, end.x, end.y, cosine_latitude) <= distance_in_meters
+    return pd.Series(mask, index=options.index)
+
+def find_closest(origin: Point, options, cosine_latitude: float, spatial_index = None):
+    if spatial_index is not None:
+        return spatial_index.closest(origin)
     distances = options.apply(lambda d: approx_distance_in_meters(origin, d, cosine_latitude))
     idx = np.argmin(distances)
-    return idx, distances[idx]
+    return idx, distances.iloc[idx]
 
 def approx_distance_in_meters(origin: Point, destination: Point, cosine_latitude: float):
     x_dist = np.abs(cosine_latitude) * METERS_TO_DEGREE * np.abs(origin.x  - destination.x)
@@ -71,18 +134,29 @@ def approx_manhattan_distance_in_meters(origin: Point, destination: Point, cosin
     y_dist =  METERS_TO_DEGREE * np.abs(origin.y  - destination.y)
     return x_dist + y_dist
 
+def segment_distances(px, py, ax, ay, bx, by):
+    """
+    distance from points (px, py) to the segments (ax, ay) -> (bx, by), all in the same planar units,
+    arrays broadcast against each other
+    """
+    dx, dy = np.subtract(bx, ax), np.subtract(by, ay)
+    length_squared = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = ((np.subtract(px, ax)) * dx + (np.subtract(py, ay)) * dy) / length_squared
+    # zero length segments are just their start point
+    t = np.clip(np.where(length_squared > 0, t, 0), 0, 1)
+    return np.hypot(np.subtract(px, ax) - t * dx, np.subtract(py, ay) - t * dy)
+
+def approx_distance_to_segment_in_meters(lons, lats, lon1, lat1, lon2, lat2, cosine_latitude: float):
+    x_scale = np.abs(cosine_latitude) * METERS_TO_DEGREE
+    return segment_distances(
+        np.multiply(lons, x_scale), np.multiply(lats, METERS_TO_DEGREE),
+        np.multiply(lon1, x_scale), np.multiply(lat1, METERS_TO_DEGREE),
+        np.multiply(lon2, x_scale), np.multiply(lat2, METERS_TO_DEGREE)
+    )
+
 def approx_euclidean_distance_to_line(origin:Point, line1: Point, line2: Point, cosine_latitude: float):
-    scaled_y_difference = np.abs(cosine_latitude) * (origin.y - line1.y)
-    distance = np.sqrt((origin.x - line1.x)**2 + scaled_y_difference**2)
-    
-    # Check if the perpendicular projection is between the two line points
-    if (line1.x <= origin.x <= line2.x or line2.x <= origin.x <= line1.x) and (line1.y <= origin.y <= line2.y or line2.y <= origin.y <= line1.y):
-        return distance
-    else:
-        # If not, return the minimum distance to the two endpoints of the line
-        distance_to_point1 = np.sqrt((origin.x - line1.y)**2 + cosine_latitude*cosine_latitude*(origin.y - line1.y)**2)
-        distance_to_point2 = np.sqrt((origin.x - line2.y)**2 + cosine_latitude*cosine_latitude*(origin.y - line2.y)**2)
-        return min(distance_to_point1, distance_to_point2)
+    return float(approx_distance_to_segment_in_meters(origin.x, origin.y, line1.x, line1.y, line2.x, line2.y, cosine_latitude))
 
 
 def filter_graph(g: nx.Graph, filter_edge = lambda graph, source_node, destination_node: True, filter_node = lambda graph, node: True):
@@ -227,32 +301,215 @@ def multisource_dijkstra(G: nx.Graph, sources, target, weight_function: lambda p
 
     return final_distance, final_route
 
-def load_gtfs_zip(filename):
-    def seconds_since_midnight(time_string):
-        try:
-            vals = time_string.split(':')
-            seconds = 0
-            for p, v in enumerate(vals):
-                seconds += int(v) * (3600/(60**p))
-            return seconds
-        except:
-            return np.nan
-    
+def gtfs_time_to_seconds(times: pd.Series) -> pd.Series:
+    # GTFS times are H:MM:SS and may run past 24:00:00 for trips after midnight,
+    # so they can't go through pd.to_datetime
+    parts = times.astype(object).str.strip().str.split(":", n=2, expand=True)
+    seconds = np.zeros(len(times))
+    for position in parts.columns:
+        values = pd.to_numeric(parts[position], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        if position > 0:
+            values = np.where(parts[position].notna(), values, 0)
+        seconds += values * (3600 / (60 ** position))
+    return pd.Series(seconds, index=times.index)
+
+def _gtfs_usecols(columns, filename):
+    if not columns or filename not in columns:
+        return None
+    wanted = set(columns[filename])
+    return lambda column: column in wanted
+
+def _parse_gtfs_zip(filename, columns = None, include_stop_times = True):
     with ZipFile(filename) as myzip:
-            
-            stops = pd.read_csv(myzip.open('stops.txt'), dtype=DATA_TYPES )
-            trips = pd.read_csv(myzip.open('trips.txt'), dtype=DATA_TYPES)
-            stop_times = pd.read_csv(myzip.open('stop_times.txt'), dtype=DATA_TYPES)
-            routes = pd.read_csv(myzip.open('routes.txt'), dtype=DATA_TYPES)
+        stops = pd.read_csv(myzip.open('stops.txt'), dtype=DATA_TYPES, usecols=_gtfs_usecols(columns, 'stops'))
+        trips = pd.read_csv(myzip.open('trips.txt'), dtype=DATA_TYPES, usecols=_gtfs_usecols(columns, 'trips'))
+        routes = pd.read_csv(myzip.open('routes.txt'), dtype=DATA_TYPES, usecols=_gtfs_usecols(columns, 'routes'))
+        if not include_stop_times:
+            return stops, trips, None, routes
+        stop_times = pd.read_csv(myzip.open('stop_times.txt'), dtype=STOP_TIMES_DATA_TYPES, usecols=_gtfs_usecols(columns, 'stop_times'))
+
+    for time_column in ("arrival_time", "departure_time"):
+        if time_column in stop_times.columns:
+            stop_times[time_column] = gtfs_time_to_seconds(stop_times[time_column])
+
+    # stop_times repeats the same few thousand ids millions of times
+    for id_column in ("trip_id", "stop_id"):
+        if id_column in stop_times.columns:
+            stop_times[id_column] = stop_times[id_column].astype("category")
+
+    return stops, trips, stop_times, routes
 
-            stops["geometry"] = stops.apply(lambda row: Point(row["stop_lon"], row["stop_lat"]), axis=1)
-            stops = gpd.GeoDataFrame(stops, geometry="geometry")
+def _select_columns(df, columns, table):
+    if not columns or table not in columns:
+        return df
+    return df[[c for c in df.columns if c in set(columns[table])]]
+
+def normalize_service_date(service_date):
+    if service_date is None:
+        return None
+    return pd.Timestamp(str(service_date)).strftime("%Y%m%d")
+
+def active_service_ids(filename, service_date = None, day_type = None):
+    """
+    service_ids running on service_date (anything pd.Timestamp accepts, e.g. "20231204")
+    or on any day of day_type (a key of DAY_TYPES), None if neither is given.
+    Applies calendar_dates.txt additions/removals on top of calendar.txt, either file may be missing.
+    """
+    if service_date is None and day_type is None:
+        return None
+    if day_type is not None and day_type not in DAY_TYPES:
+        raise Exception(f"Unknown day type: {day_type}, expected one of {list(DAY_TYPES)}")
 
-            stop_times.arrival_time = stop_times.arrival_time.apply(seconds_since_midnight)
-            stop_times.departure_time = stop_times.departure_time.apply(seconds_since_midnight)
+    with ZipFile(filename) as myzip:
+        names = set(myzip.namelist())
+        calendar = pd.read_csv(myzip.open('calendar.txt'), dtype=CALENDAR_DATA_TYPES) if 'calendar.txt' in names else pd.DataFrame(columns=['service_id', 'start_date', 'end_date'] + WEEKDAYS)
+        calendar_dates = pd.read_csv(myzip.open('calendar_dates.txt'), dtype=CALENDAR_DATA_TYPES) if 'calendar_dates.txt' in names else pd.DataFrame(columns=['service_id', 'date', 'exception_type'])
+
+    added = calendar_dates[calendar_dates.exception_type == 1]
+    removed = calendar_dates[calendar_dates.exception_type == 2]
+
+    if service_date is not None:
+        date = normalize_service_date(service_date)
+        weekday = pd.Timestamp(date).day_name().lower()
+        running = calendar[(calendar[weekday] == 1) & (calendar.start_date <= date) & (calendar.end_date >= date)]
+        return (set(running.service_id) | set(added.service_id[added.date == date])) - set(removed.service_id[removed.date == date])
+
+    days = DAY_TYPES[day_type]
+    running = calendar[(calendar[days] == 1).any(axis=1)]
+    added_weekdays = pd.to_datetime(added.date, format="%Y%m%d").dt.day_name().str.lower()
+    return set(running.service_id) | set(added.service_id[added_weekdays.isin(days)])
+
+def load_gtfs_zip(filename, columns = None, categorical_ids = True, use_cache = True, include_stop_times = True, service_date = None, day_type = None):
+    """
+    columns: optional {"stops": [...], "trips": [...], "stop_times": [...], "routes": [...]}
+    restricting which columns are returned for each file, missing columns are ignored.
+    stops always needs stop_lat and stop_lon for the geometry.
+
+    use_cache: parse each feed once and read it back from FEED_CACHE afterwards
+
+    include_stop_times: if False stop_times is returned as None and never read,
+    use iter_stop_times/read_stop_times to stream it instead
+
+    service_date/day_type: only keep trips whose service runs then (see active_service_ids),
+    stop_times is then streamed for those trips instead of being read whole
+    """
+    service_ids = active_service_ids(filename, service_date, day_type)
+    if service_ids is not None:
+        trip_columns = dict(columns) if columns else {}
+        if "trips" in trip_columns:
+            trip_columns["trips"] = list(trip_columns["trips"]) + ["service_id"]
+        stops, trips, _, routes = load_gtfs_zip(filename, trip_columns, categorical_ids, use_cache, include_stop_times=False)
+        trips = trips[trips.service_id.isin(service_ids)]
+        if columns and "trips" in columns and "service_id" not in columns["trips"]:
+            trips = trips.drop(columns="service_id")
+
+        stop_times = None
+        if include_stop_times:
+            stop_times = read_stop_times(filename, columns.get("stop_times") if columns else None, trip_ids=trips.trip_id, use_cache=use_cache)
+            if categorical_ids:
+                for id_column in ("trip_id", "stop_id"):
+                    if id_column in stop_times.columns:
+                        stop_times[id_column] = stop_times[id_column].astype("category")
+        return stops, trips, stop_times, routes
+
+    tables = None
+    if use_cache:
+        try:
+            key = FEED_CACHE.key(filename)
+            if FEED_CACHE.contains(key):
+                tables = [FEED_CACHE.read(key, table, columns.get(table) if columns else None) if (include_stop_times or table != "stop_times") else None for table in FeedCache.TABLES]
+            elif include_stop_times:
+                parsed = _parse_gtfs_zip(filename)
+                FEED_CACHE.write(key, dict(zip(FeedCache.TABLES, parsed)), source=filename)
+                tables = [_select_columns(df, columns, table) for df, table in zip(parsed, FeedCache.TABLES)]
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Feed cache unavailable for {filename}, parsing directly: {e}")
+
+    if tables is None:
+        tables = _parse_gtfs_zip(filename, columns, include_stop_times)
+
+    stops, trips, stop_times, routes = tables
+    stops = gpd.GeoDataFrame(stops, geometry=gpd.points_from_xy(stops.stop_lon, stops.stop_lat))
+
+    if stop_times is not None and not categorical_ids:
+        for id_column in ("trip_id", "stop_id"):
+            if id_column in stop_times.columns:
+                stop_times[id_column] = stop_times[id_column].astype(object)
 
     return stops, trips, stop_times, routes
 
+def _prepare_stop_times_chunk(chunk, columns, trip_ids, row_filter):
+    if trip_ids is not None:
+        chunk = chunk[chunk.trip_id.isin(trip_ids)]
+    if row_filter is not None:
+        chunk = chunk[row_filter(chunk)]
+    chunk = chunk[[c for c in chunk.columns if columns is None or c in set(columns)]]
+
+    for time_column in ("arrival_time", "departure_time"):
+        if time_column in chunk.columns and not pd.api.types.is_numeric_dtype(chunk[time_column]):
+            chunk[time_column] = gtfs_time_to_seconds(chunk[time_column])
+    for id_column in ("trip_id", "stop_id"):
+        if id_column in chunk.columns:
+            chunk[id_column] = chunk[id_column].astype(object)
+    return chunk
+
+def iter_stop_times(filename, columns = None, trip_ids = None, row_filter = None, chunksize = STOP_TIMES_CHUNK_ROWS, use_cache = True):
+    """
+    Streams stop_times.txt in chunks of chunksize rows, keeping only the given columns,
+    the rows of trip_ids and the rows where row_filter(chunk) is true.
+    Reads the cached parquet when the feed has been cached, the zip otherwise.
+    """
+    if trip_ids is not None:
+        trip_ids = set(trip_ids)
+
+    # filtering needs these columns even when the caller doesn't
+    read_columns = None
+    if columns is not None:
+        read_columns = set(columns) | {"trip_id", "stop_sequence"}
+
+    key = None
+    if use_cache:
+        try:
+            key = FEED_CACHE.key(filename)
+            if not FEED_CACHE.contains(key):
+                key = None
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Feed cache unavailable for {filename}, streaming the zip: {e}")
+            key = None
+
+    if key is not None:
+        for chunk in FEED_CACHE.iter_batches(key, "stop_times", read_columns, chunksize):
+            yield _prepare_stop_times_chunk(chunk, columns, trip_ids, row_filter)
+        return
+
+    with ZipFile(filename) as myzip:
+        usecols = (lambda c: c in read_columns) if read_columns is not None else None
+        for chunk in pd.read_csv(myzip.open('stop_times.txt'), dtype=STOP_TIMES_DATA_TYPES, usecols=usecols, chunksize=chunksize):
+            yield _prepare_stop_times_chunk(chunk, columns, trip_ids, row_filter)
+
+def _empty_stop_times(columns = None):
+    columns = columns or STOP_TIMES_COLUMNS
+    return pd.DataFrame({c: pd.Series(dtype=STOP_TIMES_EMPTY_DTYPES.get(c, object)) for c in columns})
+
+def read_stop_times(filename, columns = None, trip_ids = None, row_filter = None, chunksize = STOP_TIMES_CHUNK_ROWS, use_cache = True):
+    chunks = list(iter_stop_times(filename, columns, trip_ids, row_filter, chunksize, use_cache))
+    non_empty = [c for c in chunks if not c.empty]
+    if non_empty:
+        return pd.concat(non_empty)
+    # nothing matched (e.g. a date without service), keep the columns and dtypes callers select from
+    if chunks:
+        return chunks[0].iloc[:0]
+    return _empty_stop_times(columns)
+
+def stop_times_trip_order(filename, trip_ids = None, chunksize = STOP_TIMES_CHUNK_ROWS, use_cache = True):
+    """
+    trip ids (optionally only those in trip_ids) in the order they first appear in stop_times.txt
+    """
+    trip_order = {}
+    for chunk in iter_stop_times(filename, ["trip_id"], trip_ids=trip_ids, chunksize=chunksize, use_cache=use_cache):
+        trip_order.update(dict.fromkeys(chunk.trip_id.unique()))
+    return list(trip_order)
+
 def format_req(url, key = None):
     if not key:
         return Request(url)
@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+from zipfile import ZipFile
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+GTFS_FILES = {
+    "stops.txt": "stop_id,stop_name,stop_lat,stop_lon\nA,A,38.90,-77.03\nB,B,38.91,-77.02\nC,C,38.92,-77.01\n",
+    "routes.txt": "route_id,route_short_name,route_type\nR1,1,3\n",
+    "trips.txt": "route_id,service_id,trip_id\nR1,WEEKDAY,T1\nR1,WEEKDAY,T2\n",
+    "stop_times.txt": (
+        "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+        "T1,08:00:00,08:00:00,A,1\nT1,08:05:00,08:05:00,B,2\nT1,08:10:00,08:10:00,C,3\n"
+        "T2,09:00:00,09:00:00,A,1\nT2,09:05:00,09:05:00,B,2\n"
+    ),
+    "calendar.txt": (
+        "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+        "WEEKDAY,1,1,1,1,1,0,0,20231201,20231231\n"
+    )
+}
+
+
+@pytest.fixture
+def gtfs_zip(tmp_path):
+    """
+    a three stop, one route feed that only runs on weekdays in december 2023
+    """
+    filename = tmp_path / "gtfs.zip"
+    with ZipFile(filename, "w") as myzip:
+        for name, contents in GTFS_FILES.items():
+            myzip.writestr(name, contents)
+    return str(filename)
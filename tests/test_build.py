@@ -0,0 +1,43 @@
+import json
+import os
+from pathlib import Path
+import lib.build as build
+from lib.build import BuildManifest, BuildOrchestrator, CitySpec
+
+
+def crashing_build_city(city_info, log_file):
+    """
+    stands in for build_city: the worker building a city named crash* dies the first time
+    (or every time for crash_always), like an oom kill
+    """
+    marker = Path(log_file).with_suffix(".crashed")
+    if city_info["name"] == "crash_always" or (city_info["name"].startswith("crash") and not marker.exists()):
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+        os._exit(1)
+    return city_info["name"]
+
+
+def orchestrator(tmp_path, names, max_retries):
+    cities = [CitySpec(name, "gtfs.zip") for name in names]
+    return BuildOrchestrator(BuildManifest(cities, max_workers=1, max_retries=max_retries, log_folder=tmp_path / "logs"))
+
+
+def test_run_recovers_from_a_dead_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(build, "build_city", crashing_build_city)
+
+    results = orchestrator(tmp_path, ["crash_once", "ok"], max_retries=1).run()
+
+    assert results == {"crash_once": "done", "ok": "done"}
+
+
+def test_run_records_cities_whose_worker_keeps_dying(tmp_path, monkeypatch):
+    monkeypatch.setattr(build, "build_city", crashing_build_city)
+
+    results = orchestrator(tmp_path, ["crash_always"], max_retries=1).run()
+
+    assert results == {"crash_always": "failed"}
+    with open(tmp_path / "logs" / BuildOrchestrator.STATE_FILENAME) as f:
+        state = json.load(f)
+    assert state["crash_always"]["status"] == "failed"
+    assert "worker process died" in state["crash_always"]["error"]
@@ -0,0 +1,32 @@
+import os
+from lib.cache import DiskCache
+
+
+def test_get_survives_an_entry_evicted_by_another_process(tmp_path, monkeypatch):
+    cache = DiskCache(tmp_path)
+    cache.put("key", {"value": 1})
+    utime = os.utime
+
+    def evicted_before_touch(path, *args, **kwargs):
+        os.remove(path)
+        return utime(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "utime", evicted_before_touch)
+    assert cache.get("key") == {"value": 1}
+    assert cache.get("key") is None
+
+
+def test_evict_skips_entries_removed_while_listing(tmp_path, monkeypatch):
+    cache = DiskCache(tmp_path, max_bytes=0)
+    cache.put("a", 1)
+    (tmp_path / "gone.pkl").touch()
+    glob = type(tmp_path).glob
+
+    def listing_with_a_removed_entry(self, pattern):
+        paths = list(glob(self, pattern))
+        (tmp_path / "gone.pkl").unlink(missing_ok=True)
+        return paths
+
+    monkeypatch.setattr(type(tmp_path), "glob", listing_with_a_removed_entry)
+    cache.put("b", 2)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,43 @@
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+from lib.census import CensusFetcher, Query, Table
+
+
+class FakeCensusFetcher(CensusFetcher):
+    """
+    answers every url with one block group per tract, the fields first and the geography last like the api
+    """
+    def fetch_url(self, url):
+        params = parse_qs(urlparse(url).query)
+        fields = params["get"][0].split(",")
+        geography = dict(p.split(":") for p in params["in"])
+        rows = [[1] * len(fields) + [geography["state"], geography["county"], tract, "1"] for tract in geography["tract"].split(",")]
+        return pd.DataFrame(rows, columns=fields + Query.GEO_FIELDS)
+
+
+def make_query(table_count):
+    query = Query("2021/acs/acs5", "11", "001")
+    query.tables = [Table(f"table_{i}", f"B{i:05d}", 1, "table_0") for i in range(table_count)]
+    query.add_tract("000100")
+    query.add_tract("000200")
+    return query
+
+
+def test_raw_columns_keep_the_batch_merge_order():
+    query = make_query(Query.BATCH_SIZE + 2)
+    fields = [str(t) for t in query.tables]
+
+    assert query.raw_columns() == fields[:Query.BATCH_SIZE] + Query.GEO_FIELDS + fields[Query.BATCH_SIZE:]
+
+
+def test_fetched_columns_keep_the_batch_merge_order():
+    query = make_query(Query.BATCH_SIZE + 2)
+    names = [t.name for t in query.tables]
+
+    df = FakeCensusFetcher(requests_per_second=None).fetch([query])[0]
+
+    assert list(df.columns) == (
+        names[:Query.BATCH_SIZE] + Query.GEO_FIELDS + names[Query.BATCH_SIZE:]
+        + [f"{name}_percent" for name in names]
+    )
+    assert len(df) == 2
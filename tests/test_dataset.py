@@ -0,0 +1,81 @@
+import json
+import pytest
+import networkx as nx
+import pandas as pd
+from lib.dataset import Dataset, DATASET_FORMAT_VERSION
+
+
+def write_legacy_dataset(folder, gtfs_zip):
+    """
+    a dataset as format 1 saved it: graph.json, csv attributes with routes as tuple reprs, C has no routes
+    """
+    folder.mkdir()
+    info = {
+        "name": "legacy", "save_folder": str(folder), "gtfs_source": gtfs_zip, "num_trip_samples": 5, "poi_names": [],
+        "nearby_poi_threshold": 400, "nearby_stop_threshold": 200,
+        "census_tables_file": "lib/census_tables.yaml", "census_groupings_file": "lib/census_groupings.yaml",
+        "delay_sqlite_db_str": "", "delay_max": 30, "built": True, "include_delay": False,
+        "only_during_peak": True, "census_boundaries_file": None, "include_census": False
+    }
+    with open(folder / "dataset_info.json", "w") as f:
+        json.dump(info, f)
+
+    G = nx.DiGraph([("A", "B"), ("B", "C")])
+    with open(folder / "graph.json", "w") as f:
+        json.dump(nx.node_link_data(G), f)
+
+    nodes = pd.DataFrame({
+        "stop_id": ["A", "B", "C"],
+        "stop_name": ["A", "B", "C"],
+        "stop_lat": [38.90, 38.91, 38.92],
+        "stop_lon": [-77.03, -77.02, -77.01],
+        "geometry": ["POINT (-77.03 38.9)", "POINT (-77.02 38.91)", "POINT (-77.01 38.92)"],
+        "routes": [str(("R1",)), str(("R1", "R2")), None]
+    }, index=pd.Index(["A", "B", "C"], name="stop_id"))
+    nodes.to_csv(folder / "node_attribtes.csv")
+
+    edges = pd.DataFrame({
+        "update_count": [1, 2],
+        "driving_time": [5.0, 5.0],
+        "routes": [str(("R1",)), str(("R1", "R2"))],
+        "source_stop_id": ["A", "B"],
+        "destination_stop_id": ["B", "C"]
+    }, index=pd.MultiIndex.from_tuples([("A", "B"), ("B", "C")]))
+    edges.to_csv(folder / "edge_attributes.csv")
+
+
+def test_legacy_dataset_migrates_to_the_current_format(tmp_path, gtfs_zip, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_legacy_dataset(tmp_path / "v1", gtfs_zip)
+
+    legacy = Dataset.load(tmp_path / "v1")
+    assert legacy.node_attributes.routes.tolist() == [("R1",), ("R1", "R2"), ()]
+    assert legacy.edge_attributes.routes.tolist() == [("R1",), ("R1", "R2")]
+
+    (tmp_path / "v2").mkdir()
+    legacy.save(tmp_path / "v2")
+    migrated = Dataset.load(tmp_path / "v2")
+
+    assert migrated.info["format_version"] == DATASET_FORMAT_VERSION
+    assert list(migrated.G.edges) == [("A", "B"), ("B", "C")]
+    assert migrated.node_attributes.routes.tolist() == [("R1",), ("R1", "R2"), ()]
+    assert migrated.edge_attributes.routes.tolist() == [("R1",), ("R1", "R2")]
+
+    # and the migrated dataset saves and loads again unchanged
+    (tmp_path / "v2_again").mkdir()
+    migrated.save(tmp_path / "v2_again")
+    again = Dataset.load(tmp_path / "v2_again")
+    pd.testing.assert_frame_equal(again.node_attributes, migrated.node_attributes)
+    pd.testing.assert_frame_equal(again.edge_attributes, migrated.edge_attributes)
+
+
+def test_failed_save_leaves_no_dataset_info(tmp_path, gtfs_zip, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_legacy_dataset(tmp_path / "v1", gtfs_zip)
+    dataset = Dataset.load(tmp_path / "v1")
+    dataset.node_attributes["routes"] = [["R1"], ["R1", "R2"], []]
+
+    (tmp_path / "v2").mkdir()
+    with pytest.raises(TypeError):
+        dataset.save(tmp_path / "v2")
+    assert not (tmp_path / "v2" / "dataset_info.json").exists()
@@ -0,0 +1,29 @@
+import lib.util as util
+
+
+def test_read_stop_times_on_a_date_without_service(gtfs_zip):
+    # 20231202 is a saturday
+    stops, trips, stop_times, routes = util.load_gtfs_zip(gtfs_zip, use_cache=False, service_date="20231202")
+
+    assert trips.empty
+    assert stop_times.empty
+    assert list(stop_times.columns) == ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"]
+    assert stop_times.trip_id.tolist() == []
+    assert stop_times.stop_sequence.dtype.kind == "i"
+    assert stop_times.arrival_time.dtype.kind == "f"
+
+
+def test_read_stop_times_keeps_requested_columns_when_nothing_matches(gtfs_zip):
+    stop_times = util.read_stop_times(gtfs_zip, ["trip_id", "stop_sequence"], trip_ids=[], use_cache=False)
+
+    assert stop_times.empty
+    assert list(stop_times.columns) == ["trip_id", "stop_sequence"]
+
+
+def test_read_stop_times_on_a_service_date(gtfs_zip):
+    # 20231204 is a monday
+    stops, trips, stop_times, routes = util.load_gtfs_zip(gtfs_zip, use_cache=False, service_date="20231204")
+
+    assert sorted(trips.trip_id) == ["T1", "T2"]
+    assert len(stop_times) == 5
+    assert stop_times.arrival_time.iloc[0] == 8 * 3600